@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""Asynchronous, rate limited logging for the per file hot path
+
+Log records are handed off to a bounded queue and written by a
+background thread, so the upload workers never wait on log I/O.
+Repeats of an identical error (the same message, and for exceptions
+the same exception type) beyond a per cycle allowance are dropped
+before being queued, with a count of the suppressed records logged in
+the per cycle summary - during a receiver outage this avoids writing
+the same stack trace for every file.  Errors naming different files
+are never identical, so always pass.
+
+Optionally, a structured (JSON) record per file is written to a
+separate file via the `file_log` logger.
+
+"""
+import atexit
+from datetime import datetime
+import json
+import logging
+import threading
+from Queue import Queue, Full
+
+file_log = logging.getLogger('pheme.phinms.files')
+file_log.propagate = False
+file_log.addHandler(logging.NullHandler())
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most `allowance` repeats of each error per cycle
+
+    Errors are identified by their formatted message, plus the exception
+    type if any.  Records below ERROR level always pass.
+
+    """
+
+    def __init__(self, allowance=5):
+        logging.Filter.__init__(self)
+        self.allowance = allowance
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.ERROR:
+            return True
+        message = record.getMessage()
+        key = (record.exc_info[0] if record.exc_info else None, message)
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is None:
+                seen = self._seen[key] = [0, message]
+            seen[0] += 1
+            return seen[0] <= self.allowance
+
+    def summarise(self):
+        """Return and reset the suppressed counts as (count, msg) list"""
+        with self._lock:
+            suppressed = [(count - self.allowance, msg) for count, msg
+                          in self._seen.values()
+                          if count > self.allowance]
+            self._seen = {}
+        return suppressed
+
+
+class _ExcludeFilter(logging.Filter):
+    "Inverse of logging.Filter, rejecting records from the named logger"
+
+    def filter(self, record):
+        return not logging.Filter.filter(self, record)
+
+
+class QueueHandler(logging.Handler):
+    """Hands records off to a queue, dropping them if it's full"""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class QueueListener(threading.Thread):
+    """Background thread writing queued records to the real handlers"""
+
+    _sentinel = None
+
+    def __init__(self, queue, handlers):
+        super(QueueListener, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Flush the outstanding records and stop the thread"""
+        self.queue.put(self._sentinel)
+        self.join()
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats `file_log` records as a JSON object per line
+
+    Fields passed as `extra={'fields': {...}}` are included alongside
+    the time and event.
+
+    """
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).strftime(
+            "%Y-%m-%dT%H:%M:%S.%f"), 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+class AsyncLogging(object):
+    """Routes the root logger through a background queue
+
+    :param json_path: if defined, write a JSON record per file to this
+      path
+    :param allowance: repeats of each error to pass per cycle
+    :param maxsize: bound on queued records, beyond which records are
+      dropped rather than blocking the caller
+
+    Replaces the handlers already configured on the root logger, which
+    are driven from the background thread instead.
+
+    """
+
+    def __init__(self, json_path=None, allowance=5, maxsize=10000):
+        root = logging.getLogger()
+        queue = Queue(maxsize)
+        self.rate_limit = RateLimitFilter(allowance)
+        self.handler = QueueHandler(queue)
+        self.handler.addFilter(self.rate_limit)
+
+        handlers = root.handlers[:]
+        if json_path:
+            for handler in handlers:
+                handler.addFilter(_ExcludeFilter(file_log.name))
+            json_handler = logging.FileHandler(json_path)
+            json_handler.setFormatter(JSONFormatter())
+            json_handler.addFilter(logging.Filter(file_log.name))
+            handlers.append(json_handler)
+            file_log.addHandler(self.handler)
+            file_log.setLevel(logging.INFO)
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+
+        self.listener = QueueListener(queue, handlers)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def summarise(self):
+        """Log the records suppressed or dropped during the cycle"""
+        for count, msg in self.rate_limit.summarise():
+            logging.warn("suppressed %d repeat(s) of '%s'", count, msg)
+        if self.handler.dropped:
+            dropped, self.handler.dropped = self.handler.dropped, 0
+            logging.warn("dropped %d log record(s), queue full", dropped)
+
+    def stop(self):
+        if self.listener.is_alive():
+            self.listener.stop()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""Durable local outbox between discovery and delivery
+
+Files discovered in the workerqueue are journaled, along with their
+filedates, before any delivery is attempted.  The files are located
+afresh at delivery, as PHINMS may archive them in the meantime.
+Delivery workers
+consume the pending entries and journal an acknowledgement for each
+file delivered (or rejected), and the acknowledgements are then
+recorded in the feeder table with a single batched `markfed`.
+
+As the journal is replayed on startup, a restart resumes delivery
+immediately without re-querying the PHINMS database, and as neither
+delivery nor acknowledgement touches the database, uploads continue
+through short MySQL outages; the acknowledgements simply accumulate
+until `markfed` succeeds.
+
+The journal is a plain text file, one tab separated entry per line:
+
+  Q <filename> <filedate> [<partner>]   discovered, pending delivery
+  T <filename> <attempts>               upload attempts made so far
+  A <filename> [<details>]              delivered, pending markfed
+  F <filename>                          recorded in the feeder table
+  D <filename>                          dropped, no longer locatable
+
+where details are the JSON encoded delivery facts for the feeder
+table, see `PHINMS_DB.markfed`.
+
+"""
+import json
+import logging
+import os
+import threading
+from Queue import Queue
+
+try:
+    from collections import OrderedDict
+except ImportError:  # pragma: no cover
+    OrderedDict = dict
+
+JOURNAL_FILENAME = 'phinms_upload.journal'
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def run_workers(items, work, workers=1):
+    """Apply work to each of items using a pool of threads
+
+    :param items: iterable of argument touples for work, consumed in
+      order and no further ahead of the workers than necessary
+    :param work: callable invoked as work(*item); any exceptions
+      raised are logged, not propagated
+    :param workers: number of threads
+
+    Returns once all items have been processed.
+
+    """
+    def apply(item):
+        try:
+            work(*item)
+        except Exception, e:
+            logging.exception(e)
+
+    if workers <= 1:
+        for item in items:
+            apply(item)
+        return
+
+    queue = Queue(2 * workers)
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            apply(item)
+
+    threads = [threading.Thread(target=worker,
+                                name='delivery-worker-%d' % i)
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for item in items:
+        queue.put(item)
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+
+
+class Outbox(object):
+    """On disk journal of files between discovery and `markfed`
+
+    :param directory: where to keep the journal
+    :param compact_after: rewrite the journal once it holds this many
+      entries
+
+    """
+
+    def __init__(self, directory, compact_after=10000):
+        self.path = os.path.join(directory, JOURNAL_FILENAME)
+        self.compact_after = compact_after
+        self.pending = OrderedDict()
+        self.acked = OrderedDict()
+        self.attempts = {}
+        self._entries = 0
+        self._lock = threading.Lock()
+        self._torn = False
+        self._replay()
+        self._fh = open(self.path, 'a')
+        if self._torn:
+            # Terminate the partial entry left by a crash, so the next
+            # entry doesn't get appended to it
+            self._fh.write('\n')
+            self._fh.flush()
+
+    def _replay(self):
+        """Rebuild the pending and acked entries from the journal"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as fh:
+            for line in fh:
+                self._torn = not line.endswith('\n')
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) in (3, 4) and fields[0] == 'Q':
+                    partner = fields[3] if len(fields) == 4 else None
+                    self.pending[fields[1]] = (fields[2], partner)
+                elif len(fields) == 3 and fields[0] == 'T' and \
+                        fields[2].isdigit():
+                    if fields[1] in self.pending:
+                        self.attempts[fields[1]] = int(fields[2])
+                elif len(fields) in (2, 3) and fields[0] == 'A':
+                    try:
+                        details = json.loads(fields[2]) if \
+                            len(fields) == 3 else None
+                    except ValueError:
+                        details = None
+                    self.pending.pop(fields[1], None)
+                    self.attempts.pop(fields[1], None)
+                    self.acked[fields[1]] = details
+                elif len(fields) == 2 and fields[0] in ('F', 'D'):
+                    self.pending.pop(fields[1], None)
+                    self.attempts.pop(fields[1], None)
+                    self.acked.pop(fields[1], None)
+                else:
+                    # most likely a partial write during a crash
+                    logging.warn("skipping corrupt outbox entry '%s'",
+                                 line.rstrip('\n'))
+                    continue
+                self._entries += 1
+        if self.pending or self.acked:
+            logging.info("outbox resuming with %d pending, %d unrecorded",
+                         len(self.pending), len(self.acked))
+
+    def _write(self, lines, sync=True):
+        "Append lines to the journal; call with lock held"
+        self._fh.write(''.join(line + '\n' for line in lines))
+        self._fh.flush()
+        if sync:
+            os.fsync(self._fh.fileno())
+        self._entries += len(lines)
+
+    def __contains__(self, filename):
+        return filename in self.pending or filename in self.acked
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _pending_line(self, filename):
+        filedate, partner = self.pending[filename]
+        fields = ['Q', filename, str(filedate)]
+        if partner:
+            fields.append(partner)
+        return '\t'.join(fields)
+
+    def enqueue(self, files):
+        """Journal newly discovered files
+
+        :param files: sequence of (filename, filedate, partner)
+          touples, partner being None if unknown; those already in the
+          outbox are ignored
+
+        """
+        lines = []
+        with self._lock:
+            for filename, filedate, partner in files:
+                if filename in self:
+                    continue
+                if hasattr(filedate, 'strftime'):
+                    filedate = filedate.strftime(TIME_FORMAT)
+                self.pending[filename] = (filedate, partner)
+                lines.append(self._pending_line(filename))
+            if lines:
+                self._write(lines)
+        return len(lines)
+
+    def outstanding(self):
+        """Return the filenames of all entries not yet marked fed"""
+        with self._lock:
+            return list(self.pending) + list(self.acked)
+
+    def pending_items(self):
+        """Return the pending entries as (filename, filedate, partner)
+        touples"""
+        with self._lock:
+            return [(filename, ) + entry for filename, entry in
+                    self.pending.items()]
+
+    def attempt(self, filename):
+        """Journal an upload attempt of the pending file
+
+        Returns the number of attempts made, including this one.  The
+        journal isn't synced, at worst losing the count of attempts
+        made just before a crash.
+
+        """
+        with self._lock:
+            if filename not in self.pending:
+                return 1
+            attempts = self.attempts.get(filename, 0) + 1
+            self.attempts[filename] = attempts
+            self._write(['T\t%s\t%d' % (filename, attempts)], sync=False)
+        return attempts
+
+    def ack(self, filename, details=None):
+        """Journal the file as delivered, pending `markfed`
+
+        :param filename: the delivered file
+        :param details: optional dictionary of delivery facts, passed
+          on to `PHINMS_DB.markfed`
+
+        """
+        line = 'A\t' + filename
+        if details:
+            line += '\t' + json.dumps(details)
+        with self._lock:
+            self._write([line])
+            self.pending.pop(filename, None)
+            self.attempts.pop(filename, None)
+            self.acked[filename] = details
+
+    def drop(self, filename):
+        """Journal the pending file as dropped, no longer locatable
+
+        Left to discovery, which picks the file up again should it
+        reappear.
+
+        """
+        with self._lock:
+            self.attempts.pop(filename, None)
+            if self.pending.pop(filename, None) is not None:
+                self._write(['D\t' + filename])
+
+    def commit(self, source_db):
+        """Record all acknowledged files in the feeder table
+
+        A single batched `markfed` covers every acknowledgement
+        journaled since the last successful commit.  Returns the number
+        of feeder rows written.  Database errors are propagated, the
+        acknowledgements being retained for the next attempt.
+
+        """
+        with self._lock:
+            filenames = list(self.acked)
+            details = dict((filename, self.acked[filename]) for filename
+                           in filenames if self.acked[filename])
+        if not filenames:
+            return 0
+        count = source_db.markfed(filenames, details)
+        with self._lock:
+            self._write(['F\t' + filename for filename in filenames])
+            for filename in filenames:
+                self.acked.pop(filename, None)
+            if self._entries > self.compact_after:
+                self._compact()
+        return count
+
+    def _compact(self):
+        "Rewrite the journal with only the live entries; lock held"
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fh:
+            for filename in self.pending:
+                fh.write(self._pending_line(filename) + '\n')
+                if filename in self.attempts:
+                    fh.write('T\t%s\t%d\n' % (filename,
+                                                self.attempts[filename]))
+            for filename, details in self.acked.items():
+                line = 'A\t' + filename
+                if details:
+                    line += '\t' + json.dumps(details)
+                fh.write(line + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._fh.close()
+        os.rename(tmp, self.path)
+        self._fh = open(self.path, 'a')
+        self._entries = len(self.pending) + len(self.acked) + \
+            len(self.attempts)
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
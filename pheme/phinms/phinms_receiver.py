@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 # (C) 2011. University of Washington. All rights reserved.
+from datetime import datetime
 import logging
 import MySQLdb as mysql
-from MySQLdb import IntegrityError
+from MySQLdb.cursors import SSCursor
 
 from pheme.util.config import Config
 
@@ -11,9 +12,9 @@ class PHINMS_DB(object):
 
     A MYSQL database used by PHIN-MS, which contains information about
     files routed through PHIN-MS.  An account with only SELECT grants
-    on the PHIN-MS tables should be used.  (The 'feeder' table is used
+    on the PHIN-MS tables should be used.  (The 'feeder' tables are used
     for tracking which files have been processed, and therefore
-    requires INSERT and UPDATE grants.)
+    require CREATE, ALTER, INSERT, UPDATE and DELETE grants.)
 
     This database is where the batch filenames and related data can be
     looked up.  It is also where we persist the state for any files
@@ -23,6 +24,17 @@ class PHINMS_DB(object):
 
     LIMIT = 50
 
+    # Version of the feeder table schema, see `_create_feeder_table`
+    FEEDER_VERSION = 2
+
+    # Columns recording the delivery of each file in the feeder table
+    FEEDER_FIELDS = ('status', 'attempts', 'uploaded_at', 'duration',
+                     'bytes')
+
+    # Runs of fed rows shorter than this are left in the feeder table
+    # by `compact_feeder`
+    MIN_RUN = 10
+
     def __init__(self):
         config = Config()
         self.db = config.get('phinms', 'database')
@@ -30,24 +42,130 @@ class PHINMS_DB(object):
         self.passwd = config.get('phinms', 'password')
         self.workerqueue = config.get('phinms', 'workerqueue')
         self.feedertable = self.workerqueue + '_feeder'
+        self.rangestable = self.feedertable + '_ranges'
+
+    def feeder_version(self):
+        """ Return the version of the existing feeder table schema
+
+        0 if the table doesn't exist, 1 for the original table holding
+        only workerqueue_fk, otherwise `FEEDER_VERSION`.
+
+        """
+        cursor = self._connect().cursor()
+        cursor.execute("SHOW TABLES LIKE %s", (self.feedertable, ))
+        if not cursor.fetchone():
+            return 0
+        cursor.execute("SHOW COLUMNS FROM %s" % self.feedertable)
+        columns = [row[0] for row in cursor.fetchall()]
+        return self.FEEDER_VERSION if 'status' in columns else 1
 
     def _create_feeder_table(self):
-        """ Create the feeder table, if it doesn't already exist.
+        """ Create the feeder tables, if they don't already exist.
 
         This process is the sole user of the feeder table.  Create if
-        it it hasn't been done already.
+        it it hasn't been done already, or migrate it to the current
+        `FEEDER_VERSION`.
+
+        Version 2 adds the delivery status, attempt count, upload
+        time, duration and byte size of each file, and a ranges table
+        holding the compacted form of old rows (see `compact_feeder`).
+        Rows migrated from version 1 are recorded as 'fed' with
+        unknown delivery details, and its index duplicating the unique
+        key on workerqueue_fk is dropped.
 
         NB: the 'feeder' table is per workerqueue and named 
-        <workerqueue>_feeder
+        <workerqueue>_feeder, the ranges table <workerqueue>_feeder_ranges
 
         """
-        SQL = """CREATE TABLE IF NOT EXISTS %s (workerqueue_fk
-        BIGINT(20) NOT NULL UNIQUE, INDEX (workerqueue_fk));""" %\
-        self.feedertable
+        columns = """status ENUM('fed', 'rejected') NOT NULL DEFAULT
+        'fed', attempts INT NOT NULL DEFAULT 1, uploaded_at DATETIME NULL,
+        duration FLOAT NULL, bytes BIGINT NULL"""
         cursor = self._connect().cursor()
+        version = self.feeder_version()
+        if version == 0:
+            SQL = """CREATE TABLE %s (workerqueue_fk
+            BIGINT(20) NOT NULL PRIMARY KEY, %s);""" % (self.feedertable,
+                                                         columns)
+            cursor.execute(SQL)
+        elif version == 1:
+            logging.warn("migrating %s to version %d", self.feedertable,
+                         self.FEEDER_VERSION)
+            SQL = "ALTER TABLE %s ADD COLUMN (%s);" % (self.feedertable,
+                                                       columns)
+            cursor.execute(SQL)
+            indexes = self._indexes(self.feedertable)
+            if any(unique and cols == ['workerqueue_fk'] for unique, cols
+                   in indexes.values()):
+                for name, (unique, cols) in sorted(indexes.items()):
+                    if not unique and cols == ['workerqueue_fk']:
+                        cursor.execute("DROP INDEX %s ON %s" %
+                                       (name, self.feedertable))
+
+        SQL = """CREATE TABLE IF NOT EXISTS %s (low_fk BIGINT(20) NOT NULL
+        PRIMARY KEY, high_fk BIGINT(20) NOT NULL, files INT NOT NULL,
+        compacted_at DATETIME NOT NULL);""" % self.rangestable
         cursor.execute(SQL)
+        self._ranges_found = True
+
+    def _has_ranges(self):
+        """True if the ranges table exists
+
+        Only missing while the feeder table awaits migration by
+        `_create_feeder_table`, which modes not tracking uploads (see
+        --copy-to-tempdir) skip.
+
+        """
+        if not getattr(self, '_ranges_found', False):
+            cursor = self._connect().cursor()
+            cursor.execute("SHOW TABLES LIKE %s", (self.rangestable, ))
+            self._ranges_found = bool(cursor.fetchone())
+        return self._ranges_found
+
+    def _unfed(self):
+        """FROM and WHERE clauses selecting the unfed workerqueue rows
+
+        A row has been fed if it's in the feeder table, or within one
+        of the ranges compacted from it.
+
+        """
+        unfed = """%(workerqueue)s LEFT JOIN %(table)s ON
+        recordId=workerqueue_fk WHERE workerqueue_fk IS NULL""" % {
+            'workerqueue': self.workerqueue, 'table': self.feedertable}
+        if self._has_ranges():
+            unfed += " AND recordId > %s" % self._range_high()
+        return unfed
+
+    def _range_high(self):
+        """Expression for the high_fk of the range at or below recordId
+
+        The ranges never overlap, so only the range with the greatest
+        low_fk at or below recordId can hold it; a single point lookup
+        on the primary key, rather than scanning every range below.
+        Evaluates to 0 if there is no such range.
+
+        """
+        return """COALESCE((SELECT high_fk FROM %s WHERE low_fk <=
+        recordId ORDER BY low_fk DESC LIMIT 1), 0)""" % self.rangestable
+
+    def _filelist_query(self, progression, exclude=0,
+                        partner_column=None, exclude_partners=0):
+        sort_order = 'DESC' if progression == 'backwards' else ''
+        excluding = ''
+        if exclude:
+            excluding += " AND localFileName NOT IN (%s)" %\
+                ','.join(['%s'] * exclude)
+        if exclude_partners:
+            # NOT IN alone would also skip the files without a partner
+            excluding += " AND (%s IS NULL OR %s NOT IN (%s))" % (
+                partner_column, partner_column,
+                ','.join(['%s'] * exclude_partners))
+        return """SELECT localFileName, lastUpdateTime FROM %(unfed)s
+        %(excluding)s ORDER BY lastUpdateTime %(sort)s LIMIT %(limit)s""" %\
+            {'unfed': self._unfed(), 'excluding': excluding,
+             'sort': sort_order, 'limit': self.LIMIT}
 
-    def filelist(self, progression):
+    def filelist(self, progression, exclude=(), partner_column=None,
+                 exclude_partners=()):
         """ Query the source database for a batch of filenames
 
         Returns a set (count of up to self.LIMIT) of touples defining
@@ -57,16 +175,19 @@ class PHINMS_DB(object):
         (progression='backwards') available.  Empty list imples no
         unprocessed files are available.
 
+        :param exclude: filenames to skip, such as those already
+          discovered but not yet marked fed
+        :param partner_column: workerqueue column identifying the
+          sending partner
+        :param exclude_partners: partners (values of partner_column)
+          whose files to skip
+
         """
         cursor = self._connect().cursor()
-        sort_order = 'DESC' if progression == 'backwards' else ''
-        query = """SELECT localFileName, lastUpdateTime FROM
-        %(workerqueue)s LEFT JOIN %(table)s ON recordId=workerqueue_fk
-        WHERE workerqueue_fk IS NULL ORDER BY lastUpdateTime %(sort)s LIMIT
-        %(limit)s""" % {'workerqueue': self.workerqueue,
-                        'table': self.feedertable, 'sort': sort_order,
-                        'limit': self.LIMIT}
-        cursor.execute(query)
+        query = self._filelist_query(progression, len(exclude),
+                                     partner_column, len(exclude_partners))
+        cursor.execute(query, tuple(exclude) + tuple(exclude_partners)
+                       or None)
         files = []
         while True:
             results = cursor.fetchmany()
@@ -77,6 +198,12 @@ class PHINMS_DB(object):
 
         return files
 
+    def _name_dates_query(self, count):
+        filename_strings = ','.join(['%s'] * count)
+        return """SELECT localFileName, lastUpdateTime FROM
+        %(workerqueue)s WHERE localFileName IN (%(files)s)""" %\
+            {'workerqueue': self.workerqueue, 'files': filename_strings}
+
     def name_dates(self, filenames):
         """ Query the source database for dates matching files
 
@@ -90,11 +217,8 @@ class PHINMS_DB(object):
 
         """
         cursor = self._connect().cursor()
-        filename_strings = ','.join(['%s'] * len(filenames))
-        query = """SELECT localFileName, lastUpdateTime FROM
-        %(workerqueue)s WHERE localFileName IN (%(files)s)""" %\
-            {'workerqueue': self.workerqueue, 'files': filename_strings}
-        cursor.execute(query, tuple(filenames))
+        cursor.execute(self._name_dates_query(len(filenames)),
+                       tuple(filenames))
         results = []
         while True:
             row = cursor.fetchone()
@@ -107,36 +231,279 @@ class PHINMS_DB(object):
                              str(filenames))
         return results
 
-    def markfed(self, localFileNames):
-        """Mark the given list of filenames as read"""
-        sql = """INSERT INTO %(table)s SELECT recordId FROM
-        %(workerqueue)s WHERE localFileName IN (%(filenames)s)""" %\
-        {'workerqueue': self.workerqueue,'table': self.feedertable,
-         'filenames': ','.join(['%s' % f for f in localFileNames])}
+    def partners(self, filenames, column):
+        """ Query the sending partner of each of the given files
+
+        :param filenames: list of 'localFileName's from worker queue
+        :param column: the workerqueue column identifying the partner,
+          such as fromPartyId
+
+        Returns a dictionary of partner keyed by filename.
+
+        """
         cursor = self._connect().cursor()
-        try:
-            cursor.execute(sql)
-        except IntegrityError, e:
-            # Happens too frequently, and disguises real issues
-            #logging.error("Failed to insert localFiles %s",
-            #              str(localFileNames))
-            #logging.exception(e)
-
-            # Try again avoiding those already there
-            sql = """INSERT INTO %(table)s SELECT recordId FROM
-            %(workerqueue)s LEFT JOIN %(table)s ON recordId =
-            workerqueue_fk WHERE workerqueue_fk IS NULL AND
-            localFileName IN (%(filenames)s)""" %\
+        query = """SELECT localFileName, %(column)s FROM %(workerqueue)s
+        WHERE localFileName IN (%(files)s)""" %\
+            {'column': column, 'workerqueue': self.workerqueue,
+             'files': ','.join(['%s'] * len(filenames))}
+        cursor.execute(query, tuple(filenames))
+        return dict(cursor.fetchall())
+
+    def backlog_summary(self):
+        """ Full count of the unfed backlog
+
+        Returns a touple (unfed count, oldest unfed lastUpdateTime,
+        highest recordId in the workerqueue).  This requires the full
+        anti-join against the feeder table, so is only intended to
+        seed the incrementally maintained `BacklogStatus`.
+
+        """
+        cursor = self._connect().cursor()
+        query = "SELECT COUNT(*), MIN(lastUpdateTime) FROM %s" %\
+            self._unfed()
+        cursor.execute(query)
+        count, oldest = cursor.fetchone()
+        cursor.execute("SELECT MAX(recordId) FROM %s" % self.workerqueue)
+        max_record = cursor.fetchone()[0]
+        return int(count), oldest, max_record or 0
+
+    def arrivals_since(self, record_id):
+        """ Count workerqueue rows added after the given recordId
+
+        :param record_id: the highest recordId previously seen
+
+        Returns a touple (count, highest recordId).  Only scans the
+        primary key range beyond record_id, so is cheap to call every
+        cycle.
+
+        """
+        cursor = self._connect().cursor()
+        query = """SELECT COUNT(*), MAX(recordId) FROM %(workerqueue)s
+        WHERE recordId > %%s""" % {'workerqueue': self.workerqueue}
+        cursor.execute(query, (record_id,))
+        count, max_record = cursor.fetchone()
+        return int(count), max_record or record_id
+
+    def _markfed_select(self, count):
+        # Bound parameters, as comparing the localFileName column
+        # against unquoted numbers defeats any index on it
+        return """SELECT localFileName, recordId FROM %(workerqueue)s
+        WHERE localFileName IN (%(filenames)s)""" %\
             {'workerqueue': self.workerqueue,
-             'table': self.feedertable,
-             'filenames': ','.join(['%s' % f for f in localFileNames])}
-            cursor = self._connect().cursor()
-            cursor.execute(sql)
+             'filenames': ','.join(['%s'] * count)}
+
+    def markfed(self, localFileNames, details=None):
+        """Mark the given list of filenames as read
+
+        :param localFileNames: list of 'localFileName's from worker queue
+        :param details: optional dictionary keyed by filename, of
+          dictionaries holding any of the `FEEDER_FIELDS` for the file.
+          Files without details are recorded as 'fed' now.
+
+        Files already marked are left as they are.  Returns the number
+        of feeder rows written.
+
+        """
+        details = details or {}
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor = self._connect().cursor()
+        try:
+            cursor.execute(self._markfed_select(len(localFileNames)),
+                           tuple(localFileNames))
+            rows = []
+            for filename, record_id in cursor.fetchall():
+                facts = details.get(filename) or {}
+                rows.append((record_id, facts.get('status', 'fed'),
+                             facts.get('attempts', 1),
+                             facts.get('uploaded_at', now),
+                             facts.get('duration'), facts.get('bytes')))
+            if not rows:
+                return 0
+            sql = """INSERT IGNORE INTO %(table)s (workerqueue_fk,
+            %(fields)s) VALUES (%(values)s)""" %\
+                {'table': self.feedertable,
+                 'fields': ', '.join(self.FEEDER_FIELDS),
+                 'values': ', '.join(['%s'] *
+                                     (len(self.FEEDER_FIELDS) + 1))}
+            cursor.executemany(sql, rows)
         except Exception, e:
             logging.error("Failed to insert localFiles %s",
                           str(localFileNames))
             logging.exception(e)
             raise e
+        return cursor.rowcount
+
+    def compact_feeder(self, watermark):
+        """ Roll old rows from the feeder table into compact ranges
+
+        :param watermark: datetime; rows uploaded before this (or
+          migrated without an upload time) are candidates
+
+        Walks the workerqueue in recordId order, finding runs of
+        consecutive rows which are all either candidates or already
+        within a range.  Each run (of at least `MIN_RUN` rows, unless
+        it overlaps an existing range) replaces its rows in the feeder
+        table with a single row in the ranges table, which the
+        discovery queries continue to honour.
+
+        Returns the number of feeder rows removed.
+
+        """
+        cursor = self._connect().cursor()
+        cursor.execute("""SELECT MAX(workerqueue_fk) FROM %s WHERE
+        uploaded_at IS NULL OR uploaded_at < %%s""" % self.feedertable,
+                       (watermark, ))
+        high = cursor.fetchone()[0]
+        cursor.execute("SELECT MAX(high_fk) FROM %s" % self.rangestable)
+        high = max(high, cursor.fetchone()[0])
+        if high is None:
+            return 0
+
+        # Stream, as this walks the entire workerqueue up to high
+        stream = self._connect().cursor(SSCursor)
+        stream.execute("""SELECT recordId, workerqueue_fk IS NOT NULL
+        AND (uploaded_at IS NULL OR uploaded_at < %%s), recordId <=
+        %(range_high)s FROM %(workerqueue)s LEFT JOIN %(table)s ON
+        recordId=workerqueue_fk WHERE recordId <= %%s ORDER BY recordId"""
+                       % {'workerqueue': self.workerqueue,
+                          'table': self.feedertable,
+                          'range_high': self._range_high()},
+                       (watermark, high))
+        runs, run = [], None
+        for record_id, candidate, in_range in stream:
+            if candidate or in_range:
+                if run is None:
+                    run = [record_id, record_id, 0, False]
+                run[1] = record_id
+                run[2] += 1
+                run[3] = run[3] or bool(in_range)
+            elif run is not None:
+                runs.append(run)
+                run = None
+        if run is not None:
+            runs.append(run)
+        stream.close()
+
+        removed = 0
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for low, high, files, overlaps in runs:
+            if files < self.MIN_RUN and not overlaps:
+                continue
+            cursor.execute("""DELETE FROM %s WHERE low_fk <= %%s AND
+            high_fk >= %%s""" % self.rangestable, (high, low))
+            cursor.execute("""INSERT INTO %s (low_fk, high_fk, files,
+            compacted_at) VALUES (%%s, %%s, %%s, %%s)""" %
+                           self.rangestable, (low, high, files, now))
+            cursor.execute("""DELETE FROM %s WHERE workerqueue_fk BETWEEN
+            %%s AND %%s""" % self.feedertable, (low, high))
+            removed += cursor.rowcount
+        self._connect().commit()
+        logging.info("compacted %d feeder rows into ranges", removed)
+        return removed
+
+    def _explain(self, query, args=None):
+        """Return the EXPLAIN output for query as a list of dicts"""
+        cursor = self._connect().cursor()
+        cursor.execute("EXPLAIN " + query, args)
+        columns = [d[0] for d in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def _indexes(self, table):
+        """Return the table's indexes as {name: (unique, [columns])}"""
+        cursor = self._connect().cursor()
+        cursor.execute("SHOW INDEX FROM %s" % table)
+        columns = [d[0] for d in cursor.description]
+        indexes = {}
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            unique, cols = indexes.setdefault(
+                row['Key_name'], (not int(row['Non_unique']), []))
+            cols.append((int(row['Seq_in_index']), row['Column_name']))
+        return dict((name, (unique, [c for _, c in sorted(cols)]))
+                    for name, (unique, cols) in indexes.items())
+
+    def required_indexes(self):
+        """Indexes the discovery, lookup and ack queries depend on
+
+        Returns a list of (table, index name, columns) touples.  An
+        existing index leading with the same column is considered
+        sufficient.
+
+        """
+        return [(self.workerqueue, 'feeder_discovery',
+                 ('lastUpdateTime', 'recordId', 'localFileName')),
+                (self.workerqueue, 'feeder_lookup',
+                 ('localFileName', 'lastUpdateTime', 'recordId')),
+                (self.feedertable, 'PRIMARY', ('workerqueue_fk', )),
+                (self.rangestable, 'PRIMARY', ('low_fk', ))]
+
+    def check_schema(self):
+        """ Check the tables support the queries run against them
+
+        Runs EXPLAIN on the discovery (`filelist`), lookup
+        (`name_dates`) and ack (`markfed`) queries, reporting any full
+        table scans or filesorts, and looks for missing or redundant
+        indexes.
+
+        Returns a touple (problems, fixes), problems being a list of
+        descriptions, fixes a list of (owned, sql) touples, where
+        owned is True for fixes to tables this process owns (and can
+        therefore apply via `apply_fixes`).  Fixes to the PHINMS tables
+        are only suggested, for a DBA to apply.
+
+        """
+        problems, fixes = [], []
+        queries = (('discovery', self._filelist_query('forwards'), None),
+                   ('lookup', self._name_dates_query(1), ('', )),
+                   ('ack', self._markfed_select(1), ('', )))
+        for name, query, args in queries:
+            for row in self._explain(query, args):
+                extra = row.get('Extra') or ''
+                if row.get('type') == 'ALL':
+                    problems.append("%s query: full scan of %s" %
+                                    (name, row.get('table')))
+                if 'filesort' in extra:
+                    problems.append("%s query: filesort on %s" %
+                                    (name, row.get('table')))
+
+        tables = {}
+        for table, index, columns in self.required_indexes():
+            if table not in tables:
+                tables[table] = self._indexes(table)
+            if any(cols[0] == columns[0] for _, cols in
+                   tables[table].values()):
+                continue
+            problems.append("%s: no index on %s" % (table, columns[0]))
+            owned = table in (self.feedertable, self.rangestable)
+            if index == 'PRIMARY':
+                sql = "ALTER TABLE %s ADD PRIMARY KEY (%s)" % (
+                    table, ', '.join(columns))
+            else:
+                sql = "CREATE INDEX %s ON %s (%s)" % (
+                    index, table, ', '.join(columns))
+            fixes.append((owned, sql))
+
+        # Indexes duplicating another on the same columns are pure
+        # overhead on every insert; only checked on the owned tables
+        indexes = tables[self.feedertable]
+        for name, (unique, cols) in sorted(indexes.items()):
+            if unique:
+                continue
+            if any(other != name and other_cols == cols for other,
+                   (_, other_cols) in indexes.items()):
+                problems.append("%s: index %s is redundant" %
+                                (self.feedertable, name))
+                fixes.append((True, "DROP INDEX %s ON %s" %
+                              (name, self.feedertable)))
+        return problems, fixes
+
+    def apply_fixes(self, fixes):
+        """Apply the owned fixes returned from `check_schema`"""
+        cursor = self._connect().cursor()
+        for owned, sql in fixes:
+            if owned:
+                logging.info("applying schema fix: %s", sql)
+                cursor.execute(sql)
 
     def _connect(self):
         if getattr(self, 'conn', None):
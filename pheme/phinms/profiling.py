@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""On demand profiling of the upload cycle
+
+Profiles a requested number of cycles, writing one file per cycle into
+the log_dir.  Two modes are available:
+
+cprofile
+  Deterministic profile via cProfile, written in pstats format
+  (``*.pstats``) for inspection with the `pstats` module or any of the
+  usual viewers.  Threads started during the cycle, such as the
+  delivery workers, are profiled too and merged into the one profile.
+
+sample
+  Low overhead wall-clock sampling.  A background thread periodically
+  captures the stack of every other thread, written in the collapsed
+  stack format (``*.collapsed``) consumed by flame graph tools, each
+  stack prefixed with its thread's name.  Time blocked in MySQL or on
+  the network shows up, unlike with cProfile which only sees the
+  Python calls.
+
+Neither sees inside the `ReadAhead` expansion processes.
+
+A running daemon toggles profiling on receipt of SIGUSR1.
+
+"""
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+from time import sleep
+
+MODES = ('cprofile', 'sample')
+
+
+class StackSampler(threading.Thread):
+    """Wall-clock sampler of the stacks of all other threads
+
+    :param interval: seconds between samples
+
+    """
+
+    def __init__(self, interval=0.005):
+        super(StackSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.stacks = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            names = dict((thread.ident, thread.name) for thread in
+                         threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s:%s" % (
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path):
+        """Write the samples in collapsed stack format"""
+        with open(path, 'w') as fh:
+            for stack, count in sorted(self.stacks.items()):
+                fh.write("%s %d\n" % (stack, count))
+
+
+class CycleProfiler(object):
+    """Profiles a requested number of upload cycles
+
+    :param log_dir: directory to write the per cycle profiles
+    :param mode: one of `MODES`
+    :param cycles: number of cycles to profile when armed or toggled on
+
+    """
+
+    def __init__(self, log_dir, mode='cprofile', cycles=1):
+        if mode not in MODES:
+            raise ValueError("Requested profile mode '%s' not in "
+                             "available options %s" % (mode, MODES))
+        self.log_dir = log_dir
+        self.mode = mode
+        self.cycles = cycles
+        self.remaining = 0
+        self._count = 0
+        self._toggled = False
+
+    def arm(self, cycles=None):
+        """Profile the next `cycles` cycles"""
+        self.remaining = cycles or self.cycles
+        logging.info("profiling next %d cycle(s) (%s)", self.remaining,
+                     self.mode)
+
+    def toggle(self, *args):
+        """Signal handler, arms if idle, disarms if profiling
+
+        Only flips the state; logging from a signal handler could
+        deadlock on the lock of the logging queue, so the change is
+        logged by the next `cycle()` instead.
+
+        """
+        self.remaining = 0 if self.remaining else self.cycles
+        self._toggled = True
+
+    def install_signal_handler(self, signum=signal.SIGUSR1):
+        """Toggle profiling on receipt of signum
+
+        System calls interrupted by the signal are restarted, rather
+        than failing with EINTR, so toggling doesn't fail an upload in
+        progress.
+
+        """
+        signal.signal(signum, self.toggle)
+        signal.siginterrupt(signum, False)
+
+    def _path(self, extension):
+        self._count += 1
+        return os.path.join(self.log_dir, "phinms_upload_profile_%s_%d.%s"
+                            % (datetime.now().strftime("%Y%m%d%H%M%S"),
+                               self._count, extension))
+
+    @contextmanager
+    def cycle(self):
+        """Context manager wrapping a single cycle
+
+        Only profiles if armed, otherwise a no-op.
+
+        """
+        if self._toggled:
+            self._toggled = False
+            if self.remaining:
+                logging.info("profiling next %d cycle(s) (%s)",
+                             self.remaining, self.mode)
+            else:
+                logging.info("profiling disabled")
+        if not self.remaining:
+            yield
+            return
+
+        self.remaining -= 1
+        if self.mode == 'sample':
+            sampler = StackSampler()
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                path = self._path('collapsed')
+                sampler.write(path)
+                logging.info("cycle profile written to %s", path)
+        else:
+            profiles = [cProfile.Profile()]
+
+            def profile_thread(*args):
+                # First profile event in a newly started thread, hand
+                # over to a profiler of its own
+                profile = cProfile.Profile()
+                profiles.append(profile)
+                profile.enable()
+
+            threading.setprofile(profile_thread)
+            profiles[0].enable()
+            try:
+                yield
+            finally:
+                profiles[0].disable()
+                threading.setprofile(None)
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    try:
+                        stats.add(profile)
+                    except TypeError:
+                        pass  # nothing profiled in that thread
+                path = self._path('pstats')
+                stats.dump_stats(path)
+                logging.info("cycle profile written to %s", path)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Process pool expansion of archived batch files
+
+During backfills nearly every file comes from the archive_dir and
+needs gzip expansion, which is CPU bound.  `ReadAhead` expands (and
+reads the header of) archived files in a pool of processes, keeping a
+bounded number of expansions in flight ahead of the delivery workers,
+and hands the files off in their original order.
+
+"""
+from collections import deque
+import logging
+import multiprocessing
+
+from pheme.util.compression import expand_file
+
+
+def expand_and_check(src):
+    """Expand the archived src, returning (expanded path, first line)
+
+    Runs in the pool's worker processes.
+
+    """
+    expanded = expand_file(filename=src, zip_protocol='gzip',
+                           output='file')
+    with open(expanded, 'r') as fh:
+        first = fh.readline()
+    return expanded, first
+
+
+class ReadAhead(object):
+    """Expands archived files in a process pool ahead of delivery
+
+    :param processes: size of the process pool
+    :param window: maximum expansions in flight, defaults to twice
+      the number of processes
+
+    """
+
+    def __init__(self, processes, window=None):
+        self.pool = multiprocessing.Pool(processes)
+        self.window = window or 2 * processes
+
+    def imap(self, items, archived):
+        """Generate the items, expanding the archived ones ahead
+
+        :param items: iterable of (src, filename) touples
+        :param archived: callable returning True if src is archived
+
+        Items whose src isn't archived are generated unchanged;
+        archived ones as (src, filename, expanded path, first line).
+        Those failing expansion are logged and skipped.
+
+        """
+        in_flight = deque()
+        for src, filename in items:
+            result = None
+            if archived(src):
+                result = self.pool.apply_async(expand_and_check, (src,))
+            in_flight.append((src, filename, result))
+            if len(in_flight) >= self.window:
+                item = self._collect(*in_flight.popleft())
+                if item:
+                    yield item
+        while in_flight:
+            item = self._collect(*in_flight.popleft())
+            if item:
+                yield item
+
+    def _collect(self, src, filename, result):
+        if result is None:
+            return (src, filename)
+        try:
+            expanded, first = result.get()
+        except Exception, e:
+            logging.error("failed to expand hl7 batch file "
+                          "'%s': %s", filename, e)
+            return None
+        return (src, filename, expanded, first)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Load balancing and failover across PHEME_http_receiver endpoints
+
+Each receiver endpoint gets its own connection pool.  Uploads go to
+the healthy endpoint with the fewest outstanding requests.  An
+endpoint failing to answer, or answering with a server error (5xx), is
+taken out of rotation for an exponentially increasing period, and the
+upload fails over to the next endpoint.  Once its period expires, the
+endpoint is tried again, being returned to rotation on its first
+success.  Any other answer is the receiver rejecting the file itself,
+so fails the upload without failover or any effect on the endpoint's
+health.
+
+"""
+import logging
+import threading
+from time import time
+from urllib3 import HTTPConnectionPool
+
+
+class Endpoint(object):
+    """A single receiver endpoint and its health
+
+    :param host: receiver host
+    :param port: receiver port
+    :param timeout: seconds to wait on the receiver
+    :param maxsize: connections kept open to the receiver
+
+    """
+
+    def __init__(self, host, port, timeout=20, maxsize=1):
+        self.pool = HTTPConnectionPool(host=host, port=port,
+                                       timeout=timeout, maxsize=maxsize)
+        self.url = "%(scheme)s://%(host)s:%(port)s/" %\
+            {'scheme': self.pool.scheme, 'host': self.pool.host,
+             'port': self.pool.port}
+        self.outstanding = 0
+        self.failures = 0
+        self.down_until = 0
+
+    @property
+    def healthy(self):
+        return time() >= self.down_until
+
+    def __repr__(self):
+        return "<Endpoint %s outstanding=%d failures=%d>" % (
+            self.url, self.outstanding, self.failures)
+
+
+class ReceiverPool(object):
+    """Balances uploads across a list of receiver endpoints
+
+    :param endpoints: sequence of (host, port) touples
+    :param timeout: seconds to wait on any one receiver
+    :param retry_after: seconds a failing endpoint is first taken out
+      of rotation, doubling with each consecutive failure
+    :param max_retry_after: upper bound on the above
+    :param maxsize: connections kept open to each endpoint, which
+      should match the number of concurrent uploads
+
+    """
+
+    def __init__(self, endpoints, timeout=20, retry_after=30,
+                 max_retry_after=600, maxsize=1):
+        if not endpoints:
+            raise ValueError("at least one receiver endpoint required")
+        self.endpoints = [Endpoint(host, port, timeout, maxsize) for
+                          host, port in endpoints]
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse_endpoints(value, default_port=None):
+        """Parse a comma separated list of host[:port] endpoints
+
+        Returns a list of (host, port) touples.
+
+        """
+        endpoints = []
+        for item in value.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            host, sep, port = item.partition(':')
+            if not sep:
+                port = default_port
+            if not port:
+                raise ValueError("no port given for receiver endpoint "
+                                 "'%s'" % item)
+            endpoints.append((host, int(port)))
+        return endpoints
+
+    def _acquire(self, exclude):
+        """Pick the endpoint for the next request, not in exclude
+
+        Healthy endpoints are preferred, least outstanding requests
+        first.  If none are healthy, the one due back in rotation
+        soonest is tried.  Returns None when all are excluded.
+
+        """
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            healthy = [e for e in candidates if e.healthy]
+            if healthy:
+                endpoint = min(healthy, key=lambda e: (e.outstanding,
+                                                       e.failures))
+            else:
+                endpoint = min(candidates, key=lambda e: e.down_until)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def _release(self, endpoint, success):
+        """Release the endpoint, updating its health
+
+        :param success: True or False for a healthy or failing
+          endpoint, None to leave its health as is
+
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if success is None:
+                return
+            if success:
+                if endpoint.failures:
+                    logging.info("receiver %s back in rotation",
+                                 endpoint.url)
+                endpoint.failures = 0
+                endpoint.down_until = 0
+            else:
+                endpoint.failures += 1
+                delay = min(self.retry_after * 2 ** (endpoint.failures - 1),
+                            self.max_retry_after)
+                endpoint.down_until = time() + delay
+                logging.warn("receiver %s out of rotation for %ds",
+                             endpoint.url, delay)
+
+    def post(self, fields, filename):
+        """POST fields to a receiver, failing over as necessary
+
+        :param fields: multipart fields, see `Batchfile_Feeder.mime_parts`
+        :param filename: the file being uploaded, for logging
+
+        Returns the url of the receiver accepting the upload.  Raises
+        the last error unless one of the endpoints returns a 200, or
+        immediately should a receiver reject the file.
+
+        """
+        tried = set()
+        error = None
+        while True:
+            endpoint = self._acquire(tried)
+            if endpoint is None:
+                raise error
+            tried.add(endpoint)
+            try:
+                response = endpoint.pool.request('POST', endpoint.url,
+                                                 fields, retries=0)
+            except Exception, e:
+                # Connection error or timeout, fail over
+                self._release(endpoint, False)
+                logging.error("Failed POST of %s to %s, %s", filename,
+                              endpoint.url, e)
+                error = e
+                continue
+
+            if response.status == 200:
+                self._release(endpoint, True)
+                return endpoint.url
+            args = {'status': response.status, 'reason':
+                    response.reason, 'file': filename,
+                    'url': endpoint.url}
+            logging.error("Failed POST of %(file)s to %(url)s, "
+                          "%(reason)s", args)
+            error = RuntimeError("Error %(status)d, '%(reason)s' in "
+                                 "posting %(file)s to %(url)s" % args)
+            if response.status >= 500:
+                self._release(endpoint, False)
+                continue
+            # The receiver rejected the file, not its health at fault
+            self._release(endpoint, None)
+            raise error
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Partner aware scheduling of uploads
+
+Without scheduling, files are uploaded oldest first, so a single
+sending partner dumping a large backlog delays everyone else's fresh
+data.  `PartnerScheduler` orders each cycle's pending files by partner
+priority, round robin between partners of equal priority, and
+optionally rate limits each partner with a token bucket; files beyond
+a partner's budget are deferred to a later cycle.
+
+"""
+from time import time
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter
+
+    :param rate: tokens added per minute
+    :param capacity: maximum tokens held, defaults to a minute's worth
+
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time()
+
+    def _refill(self):
+        now = time()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    def take(self):
+        """Take a token if available, returning True if so"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait(self):
+        """Seconds until the next token is available"""
+        self._refill()
+        return max(0, (1 - self.tokens) * 60 / self.rate)
+
+
+class PartnerScheduler(object):
+    """Orders uploads by partner priority and rate limits
+
+    :param limits: dictionary keyed by partner of (rate, priority)
+      touples; rate in files per minute (None for unlimited), higher
+      priorities go first
+    :param default: (rate, priority) for unlisted partners, including
+      files whose partner is unknown (None)
+
+    """
+
+    def __init__(self, limits=None, default=(None, 0)):
+        self.limits = limits or {}
+        self.default = default
+        self._buckets = {}
+
+    @staticmethod
+    def parse_limits(value):
+        """Parse comma separated partner:rate[:priority] limits
+
+        An empty rate means unlimited.  Returns a dictionary suitable
+        for the limits parameter.
+
+        """
+        limits = {}
+        for item in value.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            parts = item.split(':')
+            if len(parts) not in (2, 3):
+                raise ValueError("invalid partner limit '%s', expected "
+                                 "partner:rate[:priority]" % item)
+            rate = float(parts[1]) if parts[1] else None
+            priority = int(parts[2]) if len(parts) == 3 else 0
+            limits[parts[0]] = (rate, priority)
+        return limits
+
+    def _limit(self, partner):
+        return self.limits.get(partner, self.default)
+
+    def _bucket(self, partner):
+        rate = self._limit(partner)[0]
+        if rate is None:
+            return None
+        if partner not in self._buckets:
+            self._buckets[partner] = TokenBucket(rate)
+        return self._buckets[partner]
+
+    def schedule(self, entries):
+        """Order the entries for upload, deferring those over budget
+
+        :param entries: sequence of (partner, item) touples, in
+          discovery order
+
+        Returns a touple (items, wait): the items to upload this
+        cycle in order, and if none could be, the seconds until the
+        next partner has budget (otherwise 0).
+
+        """
+        queues = {}
+        for partner, item in entries:
+            queues.setdefault(partner, []).append(item)
+
+        by_priority = {}
+        for partner in queues:
+            by_priority.setdefault(self._limit(partner)[1],
+                                   []).append(partner)
+
+        items, waits = [], []
+        for priority in sorted(by_priority, reverse=True):
+            # Round robin between the partners of equal priority
+            active = sorted(by_priority[priority])
+            while active:
+                for partner in active[:]:
+                    bucket = self._bucket(partner)
+                    if not queues[partner]:
+                        active.remove(partner)
+                    elif bucket is None or bucket.take():
+                        items.append(queues[partner].pop(0))
+                    else:
+                        waits.append(bucket.wait())
+                        active.remove(partner)
+        wait = min(waits) if waits and not items else 0
+        return items, wait
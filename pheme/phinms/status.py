@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""Backlog and lag bookkeeping for the upload process
+
+Answers "how far behind are we?" without repeatedly running the
+expensive anti-join between the workerqueue and the feeder table.  A
+single full count seeds the aggregates, after which they're maintained
+incrementally from the discovery cursor (new workerqueue rows past the
+highest recordId seen) and the feeder writes (rows marked fed).
+
+The daemon persists a snapshot of the aggregates to the log_dir each
+cycle, so `--status` can report without touching the PHINMS database.
+
+"""
+from collections import deque
+from datetime import datetime
+import json
+import logging
+import os
+from time import time
+
+SNAPSHOT_FILENAME = 'phinms_upload_status.json'
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def _format_duration(seconds):
+    """Render seconds in a compact, human friendly form"""
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return "%dd %02dh %02dm" % (days, hours, minutes)
+    if hours:
+        return "%dh %02dm" % (hours, minutes)
+    return "%dm %02ds" % (minutes, seconds)
+
+
+def _as_datetime(value):
+    """Return value as a datetime, or None if it isn't one"""
+    if hasattr(value, 'strftime'):
+        return value
+    try:
+        return datetime.strptime(value, TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+class BacklogStatus(object):
+    """Incrementally maintained backlog aggregates
+
+    :param window: seconds of history used when computing the drain
+      and arrival rates
+
+    """
+
+    def __init__(self, window=15 * 60):
+        self.window = window
+        self.unfed = None
+        self.oldest_unfed = None
+        self.record_cursor = None
+        self.updated = None
+        self._fed = deque()
+        self._arrived = deque()
+
+    def seed(self, source_db):
+        """Seed the aggregates with a single full count
+
+        Only necessary once per process; from then on `refresh()` and
+        `fed()` keep the numbers current.
+
+        """
+        self.unfed, self.oldest_unfed, self.record_cursor =\
+            source_db.backlog_summary()
+        self.updated = time()
+
+    def restore(self, directory):
+        """Seed the aggregates from the snapshot saved in directory
+
+        Avoids the full count on every restart; the recordId cursor
+        picks up the rows arriving since the snapshot was saved.
+        Returns False, leaving `refresh()` to seed with the full count,
+        if there's no usable snapshot.
+
+        """
+        try:
+            snapshot = self.load(directory)
+        except (IOError, ValueError), e:
+            logging.warn("Ignoring unreadable status snapshot in %s: %s",
+                         directory, e)
+            return False
+        if not snapshot or snapshot.get('unfed') is None or\
+                snapshot.get('record_cursor') is None:
+            return False
+        self.unfed = snapshot['unfed']
+        self.oldest_unfed = _as_datetime(snapshot['oldest_unfed'])
+        self.record_cursor = snapshot['record_cursor']
+        self.updated = time()
+        return True
+
+    @property
+    def seeded(self):
+        return self.unfed is not None
+
+    def refresh(self, source_db):
+        """Account for rows added to the workerqueue since last call
+
+        Uses the recordId cursor, so only the newly arrived rows are
+        touched.
+
+        """
+        if not self.seeded:
+            return self.seed(source_db)
+        count, cursor = source_db.arrivals_since(self.record_cursor)
+        if count:
+            self.unfed += count
+            self.record_cursor = cursor
+            self._arrived.append((time(), count))
+        self.updated = time()
+
+    def discovered(self, files, progression, outstanding=0,
+                   excluded_partners=(), pending=()):
+        """Account for a batch returned from `PHINMS_DB.filelist()`
+
+        :param files: the batch
+        :param progression: the progression used to query the batch
+        :param outstanding: count of files excluded from the query, as
+          already discovered but not yet marked fed
+        :param excluded_partners: partners whose files were excluded
+          from the query
+        :param pending: filedates of the outstanding files yet to be
+          delivered
+
+        A forwards batch is ordered oldest first, so, together with the
+        pending files, carries the oldest unfed lastUpdateTime for
+        free.  An empty batch means we've caught up but for the
+        outstanding files, which also corrects any drift in the
+        incremental count.  Neither holds when partners were excluded,
+        as their backlog goes unseen.
+
+        """
+        self.updated = time()
+        if excluded_partners:
+            return
+        candidates = [_as_datetime(filedate) for filedate in pending]
+        if not files:
+            self.unfed = outstanding
+        elif progression != 'backwards':
+            candidates.append(_as_datetime(files[0][1]))
+        else:
+            return
+        candidates = [filedate for filedate in candidates if filedate]
+        self.oldest_unfed = min(candidates) if candidates else None
+
+    def fed(self, count):
+        """Account for `count` rows written to the feeder table"""
+        if not count:
+            return
+        if self.seeded:
+            self.unfed = max(0, self.unfed - count)
+        self._fed.append((time(), count))
+        self.updated = time()
+
+    def _rate(self, samples):
+        "Per minute rate over the window, trimming expired samples"
+        now = time()
+        while samples and samples[0][0] < now - self.window:
+            samples.popleft()
+        if not samples:
+            return 0.0
+        elapsed = max(now - samples[0][0], 60)
+        return sum(count for _, count in samples) * 60.0 / elapsed
+
+    @property
+    def drain_rate(self):
+        """Files fed per minute over the recent window"""
+        return self._rate(self._fed)
+
+    @property
+    def arrival_rate(self):
+        """Files arriving per minute over the recent window"""
+        return self._rate(self._arrived)
+
+    @property
+    def catch_up_eta(self):
+        """Seconds until caught up at the current net drain rate
+
+        Returns None if the backlog isn't shrinking.
+
+        """
+        if not self.unfed:
+            return 0
+        net = self.drain_rate - self.arrival_rate
+        if net <= 0:
+            return None
+        return self.unfed / net * 60
+
+    def snapshot(self):
+        """Return the aggregates as a JSON friendly dictionary"""
+        oldest = self.oldest_unfed
+        if hasattr(oldest, 'strftime'):
+            oldest = oldest.strftime(TIME_FORMAT)
+        return {'unfed': self.unfed,
+                'oldest_unfed': oldest,
+                'record_cursor': self.record_cursor,
+                'drain_rate': round(self.drain_rate, 2),
+                'arrival_rate': round(self.arrival_rate, 2),
+                'catch_up_eta': self.catch_up_eta,
+                'updated': self.updated}
+
+    def report(self, snapshot=None):
+        """Single line summary, suitable for the log or a terminal
+
+        :param snapshot: report on a previously saved snapshot rather
+          than the live aggregates
+
+        """
+        s = snapshot or self.snapshot()
+        if s['unfed'] is None:
+            return "backlog: unknown (not yet seeded)"
+        parts = ["backlog: %d unfed" % s['unfed']]
+        if s['oldest_unfed']:
+            oldest = s['oldest_unfed']
+            try:
+                lag = datetime.now() - datetime.strptime(oldest,
+                                                         TIME_FORMAT)
+                parts.append("oldest %s (lag %s)" %
+                             (oldest, _format_duration(
+                                 lag.days * 86400 + lag.seconds)))
+            except ValueError:
+                parts.append("oldest %s" % oldest)
+        parts.append("draining %.1f/min" % s['drain_rate'])
+        parts.append("arriving %.1f/min" % s['arrival_rate'])
+        if s['catch_up_eta'] is None:
+            parts.append("not catching up")
+        else:
+            parts.append("caught up in %s" %
+                         _format_duration(s['catch_up_eta']))
+        if s['updated']:
+            parts.append("as of %s" % datetime.fromtimestamp(
+                s['updated']).strftime(TIME_FORMAT))
+        return ", ".join(parts)
+
+    def save(self, directory):
+        """Atomically persist a snapshot into the given directory"""
+        path = os.path.join(directory, SNAPSHOT_FILENAME)
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as fh:
+                json.dump(self.snapshot(), fh)
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            logging.error("Failed to save status snapshot to %s: %s",
+                          path, e)
+
+    @staticmethod
+    def load(directory):
+        """Return the snapshot saved in directory, or None if absent"""
+        path = os.path.join(directory, SNAPSHOT_FILENAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as fh:
+            return json.load(fh)
@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pheme.phinms.asynclog import AsyncLogging, RateLimitFilter, file_log
+
+
+class ListHandler(logging.Handler):
+    """Collects the formatted records"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class TestAsyncLogging(unittest.TestCase):
+
+    def setUp(self):
+        super(TestAsyncLogging, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = logging.getLogger()
+        self.saved = self.root.handlers[:], self.root.level
+        self.collector = ListHandler()
+        self.root.handlers = [self.collector]
+        self.root.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.root.handlers, level = self.saved
+        self.root.setLevel(level)
+        file_log.handlers = file_log.handlers[:1]
+        shutil.rmtree(self.tmpdir)
+        super(TestAsyncLogging, self).tearDown()
+
+    def test_rate_limit(self):
+        async_log = AsyncLogging(allowance=2)
+        for i in range(5):
+            logging.error("receiver %s unavailable", 'host1')
+            logging.error("failed to upload %s", i)
+            logging.info("posted %s", i)
+        async_log.summarise()
+        async_log.stop()
+        messages = self.collector.messages
+        self.assertEquals(len([m for m in messages
+                               if m.startswith('receiver')]), 2)
+        self.assertEquals(len([m for m in messages
+                               if m.startswith('failed')]), 5)
+        self.assertEquals(len([m for m in messages
+                               if m.startswith('posted')]), 5)
+        self.assertTrue("suppressed 3 repeat(s) of 'receiver host1 "
+                        "unavailable'" in messages)
+
+    def test_json(self):
+        path = os.path.join(self.tmpdir, 'files.json')
+        async_log = AsyncLogging(json_path=path)
+        file_log.info('posted', extra={'fields': {'file': 'f1'}})
+        async_log.stop()
+        self.assertEquals(self.collector.messages, [])
+        with open(path) as fh:
+            entry = json.loads(fh.readline())
+        self.assertEquals(entry['event'], 'posted')
+        self.assertEquals(entry['file'], 'f1')
+
+
+def test_rate_limit_filter():
+    f = RateLimitFilter(allowance=1)
+    record = logging.LogRecord('x', logging.ERROR, 'path', 1, 'msg', (),
+                               None)
+    assert(f.filter(record))
+    assert(not f.filter(record))
+    assert(f.summarise() == [(1, 'msg')])
+    assert(f.filter(record))
+    try:
+        raise IOError('msg')
+    except IOError:
+        record.exc_info = sys.exc_info()
+    assert(f.filter(record))
+
+
+if '__main__' == __name__:
+    unittest.main()
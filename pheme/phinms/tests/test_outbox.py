@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from pheme.phinms.outbox import Outbox, run_workers
+
+
+class FakeDB(object):
+    """Stand in for PHINMS_DB, recording markfed calls"""
+
+    def __init__(self):
+        self.fed = []
+        self.details = {}
+        self.down = False
+
+    def markfed(self, filenames, details=None):
+        if self.down:
+            raise RuntimeError("database unavailable")
+        self.fed.extend(filenames)
+        self.details.update(details or {})
+        return len(filenames)
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = FakeDB()
+        self.files = [('f1', datetime(2013, 1, 2, 3, 4, 5), None),
+                      ('f2', '2009-01-03T16:20:19', 'HOSP')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestOutbox, self).tearDown()
+
+    def test_enqueue(self):
+        outbox = Outbox(self.tmpdir)
+        self.assertEquals(outbox.enqueue(self.files), 2)
+        self.assertEquals(outbox.enqueue(self.files), 0)
+        self.assertEquals(len(outbox), 2)
+        self.assertEquals(outbox.pending_items()[0],
+                          ('f1', '2013-01-02T03:04:05', None))
+
+    def test_ack_commit(self):
+        outbox = Outbox(self.tmpdir)
+        outbox.enqueue(self.files)
+        outbox.ack('f1')
+        self.assertTrue('f1' in outbox)
+        self.assertEquals(len(outbox), 1)
+        self.assertEquals(outbox.commit(self.db), 1)
+        self.assertEquals(self.db.fed, ['f1'])
+        self.assertFalse('f1' in outbox)
+        self.assertEquals(outbox.commit(self.db), 0)
+
+    def test_outage(self):
+        outbox = Outbox(self.tmpdir)
+        outbox.enqueue(self.files)
+        outbox.ack('f1')
+        self.db.down = True
+        self.assertRaises(RuntimeError, outbox.commit, self.db)
+        outbox.ack('f2')
+        self.db.down = False
+        self.assertEquals(outbox.commit(self.db), 2)
+
+    def test_replay(self):
+        outbox = Outbox(self.tmpdir)
+        outbox.enqueue(self.files)
+        outbox.ack('f1')
+        outbox.close()
+
+        outbox = Outbox(self.tmpdir)
+        self.assertEquals(list(outbox.acked), ['f1'])
+        self.assertEquals(outbox.pending_items(),
+                          [('f2', '2009-01-03T16:20:19', 'HOSP')])
+        outbox.commit(self.db)
+        outbox.close()
+
+        outbox = Outbox(self.tmpdir)
+        self.assertFalse(outbox.acked)
+        self.assertEquals(len(outbox), 1)
+
+    def test_torn_entry(self):
+        outbox = Outbox(self.tmpdir)
+        outbox.enqueue(self.files)
+        outbox.close()
+        # as if the process crashed part way through an entry
+        with open(outbox.path, 'a') as fh:
+            fh.write('Q\tf')
+
+        outbox = Outbox(self.tmpdir)
+        outbox.ack('f2')
+        outbox.close()
+        outbox = Outbox(self.tmpdir)
+        self.assertEquals(list(outbox.acked), ['f2'])
+        self.assertEquals(len(outbox), 1)
+
+    def test_drop(self):
+        outbox = Outbox(self.tmpdir)
+        outbox.enqueue(self.files)
+        outbox.drop('f1')
+        self.assertFalse('f1' in outbox)
+        outbox.close()
+
+        outbox = Outbox(self.tmpdir)
+        self.assertEquals([entry[0] for entry in outbox.pending_items()],
+                          ['f2'])
+
+    def test_attempts(self):
+        outbox = Outbox(self.tmpdir, compact_after=3)
+        outbox.enqueue(self.files)
+        self.assertEquals(outbox.attempt('f1'), 1)
+        self.assertEquals(outbox.attempt('f1'), 2)
+        self.assertEquals(outbox.attempt('f2'), 1)
+        self.assertEquals(outbox.attempt('unknown'), 1)
+        outbox.ack('f2')
+        self.assertFalse('f2' in outbox.attempts)
+        outbox.commit(self.db)
+        outbox.close()
+
+        outbox = Outbox(self.tmpdir)
+        self.assertEquals(outbox.attempts, {'f1': 2})
+        self.assertEquals(outbox.attempt('f1'), 3)
+
+    def test_details(self):
+        outbox = Outbox(self.tmpdir)
+        outbox.enqueue(self.files)
+        outbox.ack('f1', {'status': 'fed', 'bytes': 10})
+        outbox.close()
+
+        outbox = Outbox(self.tmpdir)
+        outbox.commit(self.db)
+        self.assertEquals(self.db.details, {'f1': {'status': 'fed',
+                                                   'bytes': 10}})
+
+    def test_compact(self):
+        outbox = Outbox(self.tmpdir, compact_after=3)
+        outbox.enqueue(self.files)
+        outbox.ack('f1')
+        outbox.commit(self.db)
+        outbox.close()
+        with open(os.path.join(self.tmpdir, 'phinms_upload.journal')) as fh:
+            self.assertEquals(len(fh.readlines()), 1)
+        self.assertEquals(len(Outbox(self.tmpdir)), 1)
+
+
+def test_run_workers():
+    results = []
+    run_workers([(i,) for i in range(20)], results.append, workers=4)
+    assert(sorted(results) == range(20))
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -22,11 +22,32 @@ class TestPhinmsDB(unittest.TestCase):
         result = cursor.fetchone()
         self.assertTrue(int(result[0]) >= 0)
 
+    def testFeederVersion(self):
+        "Confirm feeder table is at, or migrated to the current version"
+        self.phinms._create_feeder_table()
+        self.assertEquals(self.phinms.feeder_version(),
+                          PHINMS_DB.FEEDER_VERSION)
+
     def test_filelist(self):
         "Confirm query works"
         files = self.phinms.filelist(progression=None)
         self.assertTrue(len(files) <= self.phinms.LIMIT)
 
+    def test_filelist_query_partners(self):
+        "Confirm excluding partners keeps the files without a partner"
+        query = self.phinms._filelist_query('forwards', 0, 'fromPartyId',
+                                            2)
+        self.assertTrue("(fromPartyId IS NULL OR fromPartyId NOT IN "
+                        "(%s,%s))" in query)
+
+    def test_check_schema(self):
+        "Confirm the schema check runs, and finds the feeder table ok"
+        self.phinms._create_feeder_table()
+        problems, fixes = self.phinms.check_schema()
+        feeder = self.phinms.feedertable
+        self.assertFalse([p for p in problems if p.startswith(feeder)])
+        self.assertFalse([f for f in fixes if f[0]])
+
     def test_name_dates(self):
         files = 'missing',
         self.assertRaises(ValueError, self.phinms.name_dates, files)
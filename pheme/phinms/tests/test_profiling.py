@@ -0,0 +1,131 @@
+import logging
+import os
+import pstats
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import unittest
+from time import sleep
+from pheme.phinms.outbox import run_workers
+from pheme.phinms.profiling import CycleProfiler
+
+
+def deliver_slowly(item):
+    sleep(0.02)
+
+
+class TestCycleProfiler(unittest.TestCase):
+
+    def setUp(self):
+        super(TestCycleProfiler, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TestCycleProfiler, self).tearDown()
+
+    def test_bad_mode(self):
+        self.assertRaises(ValueError, CycleProfiler, self.tmpdir, 'bogus')
+
+    def test_unarmed(self):
+        profiler = CycleProfiler(self.tmpdir)
+        with profiler.cycle():
+            pass
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+    def test_cprofile(self):
+        profiler = CycleProfiler(self.tmpdir, cycles=2)
+        profiler.arm()
+        for i in range(3):
+            with profiler.cycle():
+                sleep(0.01)
+        files = os.listdir(self.tmpdir)
+        self.assertEquals(len(files), 2)
+        self.assertTrue(all(f.endswith('.pstats') for f in files))
+
+    def test_sample(self):
+        profiler = CycleProfiler(self.tmpdir, mode='sample')
+        profiler.toggle()
+        with profiler.cycle():
+            sleep(0.05)
+        files = os.listdir(self.tmpdir)
+        self.assertEquals(len(files), 1)
+        with open(os.path.join(self.tmpdir, files[0])) as fh:
+            self.assertTrue('test_sample' in fh.read())
+
+    def test_cprofile_workers(self):
+        profiler = CycleProfiler(self.tmpdir)
+        profiler.arm()
+        with profiler.cycle():
+            run_workers([(i, ) for i in range(4)], deliver_slowly, 2)
+        path = os.path.join(self.tmpdir, os.listdir(self.tmpdir)[0])
+        functions = [func[2] for func in pstats.Stats(path).stats]
+        self.assertTrue('deliver_slowly' in functions)
+
+    def test_sample_workers(self):
+        profiler = CycleProfiler(self.tmpdir, mode='sample')
+        profiler.arm()
+        with profiler.cycle():
+            run_workers([(i, ) for i in range(4)], deliver_slowly, 2)
+        with open(os.path.join(self.tmpdir,
+                               os.listdir(self.tmpdir)[0])) as fh:
+            stacks = fh.read()
+        self.assertTrue('delivery-worker-0;' in stacks)
+        self.assertTrue('deliver_slowly' in stacks)
+
+    def test_toggle_off(self):
+        profiler = CycleProfiler(self.tmpdir, cycles=5)
+        profiler.toggle()
+        profiler.toggle()
+        self.assertEquals(profiler.remaining, 0)
+
+    def test_signal_during_blocking_call(self):
+        profiler = CycleProfiler(self.tmpdir)
+        previous = signal.getsignal(signal.SIGUSR1)
+        profiler.install_signal_handler()
+        reader, writer = socket.socketpair()
+        pid = os.getpid()
+
+        def interrupt():
+            sleep(0.1)
+            os.kill(pid, signal.SIGUSR1)
+            sleep(0.1)
+            writer.send('done')
+
+        thread = threading.Thread(target=interrupt)
+        try:
+            thread.start()
+            self.assertEquals(reader.recv(4), 'done')
+        finally:
+            thread.join()
+            signal.signal(signal.SIGUSR1, previous)
+            reader.close()
+            writer.close()
+        self.assertEquals(profiler.remaining, 1)
+
+    def test_toggle_logs_from_cycle(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        root = logging.getLogger()
+        root.addHandler(handler)
+        level = root.level
+        root.setLevel(logging.INFO)
+        try:
+            profiler = CycleProfiler(self.tmpdir, cycles=2)
+            profiler.toggle()
+            self.assertEquals(records, [])
+            with profiler.cycle():
+                pass
+        finally:
+            root.removeHandler(handler)
+            root.setLevel(level)
+        self.assertEquals(records[0].getMessage(),
+                          "profiling next 2 cycle(s) (cprofile)")
+        self.assertEquals(profiler.remaining, 1)
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,53 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from pheme.phinms.readahead import ReadAhead
+
+
+class TestReadAhead(unittest.TestCase):
+
+    def setUp(self):
+        super(TestReadAhead, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.read_ahead = ReadAhead(2, window=3)
+
+    def tearDown(self):
+        self.read_ahead.close()
+        shutil.rmtree(self.tmpdir)
+        super(TestReadAhead, self).tearDown()
+
+    def _archive(self, filename, contents):
+        path = os.path.join(self.tmpdir, filename + '.gz')
+        fh = gzip.open(path, 'wb')
+        fh.write(contents)
+        fh.close()
+        return path
+
+    def test_in_order(self):
+        items = []
+        for i in range(6):
+            if i % 2:
+                items.append(('/received/%d' % i, str(i)))
+            else:
+                items.append((self._archive(str(i), 'FHS|%d\n' % i),
+                              str(i)))
+        results = list(self.read_ahead.imap(
+            items, lambda src: src.endswith('.gz')))
+        self.assertEquals([r[1] for r in results],
+                          [str(i) for i in range(6)])
+        self.assertEquals(results[1], ('/received/1', '1'))
+        src, filename, expanded, first = results[2]
+        self.assertEquals(first, 'FHS|2\n')
+        self.assertTrue(os.path.exists(expanded))
+
+    def test_failed_expansion(self):
+        missing = os.path.join(self.tmpdir, 'missing.gz')
+        results = list(self.read_ahead.imap([(missing, 'missing')],
+                                            lambda src: True))
+        self.assertEquals(results, [])
+
+
+if '__main__' == __name__:
+    unittest.main()
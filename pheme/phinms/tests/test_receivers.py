@@ -0,0 +1,87 @@
+import unittest
+from pheme.phinms.receivers import ReceiverPool
+
+
+class FakeResponse(object):
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'OK' if status == 200 else 'Server Error'
+
+
+class FakePool(object):
+    """Stand in for the urllib3 pool, returning a fixed status"""
+
+    def __init__(self, status=200):
+        self.status = status
+        self.requests = 0
+
+    def request(self, method, url, fields, retries=None):
+        self.requests += 1
+        if isinstance(self.status, Exception):
+            raise self.status
+        return FakeResponse(self.status)
+
+
+class TestReceiverPool(unittest.TestCase):
+
+    def setUp(self):
+        super(TestReceiverPool, self).setUp()
+        self.receivers = ReceiverPool([('host1', 8001), ('host2', 8002)])
+        for endpoint in self.receivers.endpoints:
+            endpoint.pool = FakePool()
+
+    def test_parse_endpoints(self):
+        self.assertEquals(ReceiverPool.parse_endpoints(
+            'host1:8001, host2', '8080'), [('host1', 8001),
+                                           ('host2', 8080)])
+        self.assertRaises(ValueError, ReceiverPool.parse_endpoints,
+                          'host1')
+
+    def test_maxsize(self):
+        receivers = ReceiverPool([('host1', 8001)], maxsize=4)
+        self.assertEquals(receivers.endpoints[0].pool.pool.maxsize, 4)
+
+    def test_least_outstanding(self):
+        first, second = self.receivers.endpoints
+        first.outstanding = 2
+        url = self.receivers.post({}, 'file')
+        self.assertEquals(url, second.url)
+        self.assertEquals(second.outstanding, 0)
+
+    def test_failover(self):
+        first, second = self.receivers.endpoints
+        first.pool.status = 500
+        self.assertEquals(self.receivers.post({}, 'file'), second.url)
+        self.assertFalse(first.healthy)
+        self.assertEquals(first.failures, 1)
+        # unhealthy endpoint is skipped
+        self.receivers.post({}, 'file')
+        self.assertEquals(first.pool.requests, 1)
+
+    def test_rejection(self):
+        first, second = self.receivers.endpoints
+        first.pool.status = second.pool.status = 400
+        self.assertRaises(RuntimeError, self.receivers.post, {}, 'file')
+        self.assertEquals(first.pool.requests + second.pool.requests, 1)
+        self.assertTrue(all(e.healthy and not e.failures and
+                            not e.outstanding for e in
+                            self.receivers.endpoints))
+
+    def test_all_down(self):
+        for endpoint in self.receivers.endpoints:
+            endpoint.pool.status = IOError('connection refused')
+        self.assertRaises(IOError, self.receivers.post, {}, 'file')
+        self.assertFalse(any(e.healthy for e in
+                             self.receivers.endpoints))
+
+    def test_recovery(self):
+        first, second = self.receivers.endpoints
+        first.failures, first.down_until = 3, 1
+        second.pool.status = 500
+        self.assertEquals(self.receivers.post({}, 'file'), first.url)
+        self.assertEquals(first.failures, 0)
+
+
+if '__main__' == __name__:
+    unittest.main()
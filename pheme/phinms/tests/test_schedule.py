@@ -0,0 +1,50 @@
+import unittest
+from pheme.phinms.schedule import PartnerScheduler, TokenBucket
+
+
+class TestPartnerScheduler(unittest.TestCase):
+
+    def test_parse_limits(self):
+        limits = PartnerScheduler.parse_limits('BIG:60, FAST::10, *:120:1')
+        self.assertEquals(limits, {'BIG': (60.0, 0), 'FAST': (None, 10),
+                                   '*': (120.0, 1)})
+        self.assertRaises(ValueError, PartnerScheduler.parse_limits,
+                          'BIG')
+
+    def test_round_robin(self):
+        scheduler = PartnerScheduler()
+        entries = [('BIG', 'b1'), ('BIG', 'b2'), ('BIG', 'b3'),
+                   ('SMALL', 's1')]
+        items, wait = scheduler.schedule(entries)
+        self.assertEquals(items, ['b1', 's1', 'b2', 'b3'])
+        self.assertEquals(wait, 0)
+
+    def test_priority(self):
+        scheduler = PartnerScheduler({'FAST': (None, 10)})
+        entries = [('BIG', 'b1'), ('BIG', 'b2'), (None, 'u1'),
+                   ('FAST', 'f1'), ('FAST', 'f2')]
+        items, wait = scheduler.schedule(entries)
+        self.assertEquals(items[:2], ['f1', 'f2'])
+        self.assertEquals(sorted(items[2:]), ['b1', 'b2', 'u1'])
+
+    def test_rate_limit(self):
+        scheduler = PartnerScheduler({'BIG': (2, 0)})
+        entries = [('BIG', 'b%d' % i) for i in range(5)] + \
+            [('SMALL', 's1')]
+        items, wait = scheduler.schedule(entries)
+        self.assertEquals(items, ['b0', 's1', 'b1'])
+        self.assertEquals(wait, 0)
+        items, wait = scheduler.schedule(entries[2:5])
+        self.assertEquals(items, [])
+        self.assertTrue(0 < wait <= 30)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(60)
+    taken = sum(1 for i in range(100) if bucket.take())
+    assert(taken == 60)
+    assert(0 < bucket.wait() <= 1)
+
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,119 @@
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from pheme.phinms.status import BacklogStatus
+
+
+class FakeDB(object):
+    """Stand in for PHINMS_DB, answering only the status queries"""
+
+    def __init__(self):
+        self.summary = (10, datetime(2013, 1, 2, 3, 4, 5), 100)
+        self.arrivals = (0, 100)
+
+    def backlog_summary(self):
+        return self.summary
+
+    def arrivals_since(self, record_id):
+        return self.arrivals
+
+
+class TestBacklogStatus(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBacklogStatus, self).setUp()
+        self.db = FakeDB()
+        self.status = BacklogStatus()
+
+    def test_unseeded(self):
+        self.assertFalse(self.status.seeded)
+        self.assertTrue('unknown' in self.status.report())
+
+    def test_incremental(self):
+        self.status.refresh(self.db)
+        self.assertEquals(self.status.unfed, 10)
+        self.db.arrivals = (5, 105)
+        self.status.refresh(self.db)
+        self.assertEquals(self.status.unfed, 15)
+        self.assertEquals(self.status.record_cursor, 105)
+        self.status.fed(3)
+        self.assertEquals(self.status.unfed, 12)
+        self.assertTrue(self.status.drain_rate > 0)
+
+    def test_caught_up(self):
+        self.status.refresh(self.db)
+        self.status.discovered([], 'forwards')
+        self.assertEquals(self.status.unfed, 0)
+        self.assertEquals(self.status.catch_up_eta, 0)
+
+    def test_partners_excluded(self):
+        self.status.refresh(self.db)
+        oldest = self.status.oldest_unfed
+        self.status.discovered([], 'forwards', 100, ['HOSP'])
+        self.assertEquals(self.status.unfed, 10)
+        self.status.discovered([('f1', datetime(2013, 2, 1))],
+                               'forwards', 0, ['HOSP'])
+        self.assertEquals(self.status.oldest_unfed, oldest)
+
+    def test_oldest_from_batch(self):
+        self.status.refresh(self.db)
+        newer = datetime(2013, 2, 1)
+        self.status.discovered([('f1', newer)], 'forwards')
+        self.assertEquals(self.status.oldest_unfed, newer)
+        self.status.discovered([('f2', datetime(2013, 3, 1))],
+                               'backwards')
+        self.assertEquals(self.status.oldest_unfed, newer)
+
+    def test_restore(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.assertFalse(self.status.restore(tmpdir))
+            self.status.refresh(self.db)
+            self.status.fed(4)
+            self.status.save(tmpdir)
+
+            status = BacklogStatus()
+            self.assertTrue(status.restore(tmpdir))
+            self.db.summary = None  # a full count would fail
+            self.db.arrivals = (2, 102)
+            status.refresh(self.db)
+            self.assertEquals(status.unfed, 8)
+            self.assertEquals(status.record_cursor, 102)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_oldest_pending(self):
+        self.status.refresh(self.db)
+        batch = [('f3', datetime(2013, 3, 1))]
+        self.status.discovered(batch, 'forwards', 2,
+                               pending=['2013-02-01T00:00:00',
+                                        datetime(2013, 4, 1)])
+        self.assertEquals(self.status.oldest_unfed, datetime(2013, 2, 1))
+        # moves on as the pending files are delivered
+        self.status.discovered(batch, 'forwards', 1,
+                               pending=[datetime(2013, 4, 1)])
+        self.assertEquals(self.status.oldest_unfed, datetime(2013, 3, 1))
+        self.status.discovered([], 'forwards', 1,
+                               pending=[datetime(2013, 4, 1)])
+        self.assertEquals(self.status.oldest_unfed, datetime(2013, 4, 1))
+        self.assertEquals(self.status.unfed, 1)
+
+    def test_save_load(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.assertEquals(BacklogStatus.load(tmpdir), None)
+            self.status.refresh(self.db)
+            self.status.save(tmpdir)
+            snapshot = BacklogStatus.load(tmpdir)
+            self.assertEquals(snapshot['unfed'], 10)
+            self.assertEquals(snapshot['oldest_unfed'],
+                              '2013-01-02T03:04:05')
+            self.assertTrue('10 unfed' in
+                            BacklogStatus().report(snapshot))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if '__main__' == __name__:
+    unittest.main()
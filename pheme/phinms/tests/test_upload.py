@@ -1,5 +1,64 @@
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
-from pheme.phinms.upload import Batchfile_Feeder, archive_by_date
+from pheme.phinms.outbox import Outbox
+from pheme.phinms.schedule import PartnerScheduler
+from pheme.phinms.status import BacklogStatus
+from pheme.phinms.upload import Batchfile_Feeder, Execute, archive_by_date
+
+
+class FakeDB(object):
+    """Stand in for PHINMS_DB, serving a fixed list of unfed files"""
+
+    def __init__(self, files=(), partners=None):
+        self.files = list(files)
+        self.partner_map = partners or {}
+        self.fed = []
+        self.queries = []
+
+    def backlog_summary(self):
+        return len(self.files), None, 0
+
+    def arrivals_since(self, cursor):
+        return 0, cursor
+
+    def filelist(self, progression, exclude=(), partner_column=None,
+                 exclude_partners=()):
+        self.queries.append(list(exclude_partners))
+        return [(filename, filedate) for filename, filedate in self.files
+                if filename not in exclude and filename not in self.fed
+                and self.partner_map.get(filename) not in
+                exclude_partners]
+
+    def partners(self, filenames, column):
+        return dict((filename, self.partner_map.get(filename)) for
+                    filename in filenames)
+
+    def markfed(self, filenames, details=None):
+        self.fed.extend(filenames)
+        return len(filenames)
+
+
+class FakeFeeder(Batchfile_Feeder):
+    """Feeder over the given directories, recording rather than posting"""
+
+    def __init__(self, receiving_dir, archive_dir, source_db, status,
+                 outbox):
+        self.verbosity = 0
+        self.source_db = source_db
+        self.status = status
+        self.outbox = outbox
+        self.phinms_receiving_dir = receiving_dir
+        self.phinms_archive_dir = archive_dir
+        self.source_dir = receiving_dir
+        self._copy_tempdir = None
+        self.posted = []
+
+    def _post(self, filepath, filename):
+        self.posted.append(filename)
+        return 'http://receiver/'
 
 
 class TestUpload(unittest.TestCase):
@@ -17,11 +76,162 @@ class TestUpload(unittest.TestCase):
         # go to PHEME_http_receiver channel in Mirth, and see if it arrived
 
 
+class TestCycle(unittest.TestCase):
+
+    def setUp(self):
+        super(TestCycle, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.receiving_dir = os.path.join(self.tmpdir, 'receiving')
+        self.archive_dir = os.path.join(self.tmpdir, 'archive')
+        os.makedirs(self.receiving_dir)
+        os.makedirs(os.path.join(self.archive_dir, '2009-01'))
+        self.outbox = Outbox(self.tmpdir)
+        self.status = BacklogStatus()
+        self.execute = Execute()
+        self.execute.scheduler = PartnerScheduler()
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.tmpdir)
+        super(TestCycle, self).tearDown()
+
+    def write(self, filename, facility, archived=False):
+        header = 'FHS|^~\\&|APP|%s|PHEME|\n' % facility
+        if archived:
+            fh = gzip.open(os.path.join(self.archive_dir, '2009-01',
+                                        filename + '.gz'), 'wb')
+        else:
+            fh = open(os.path.join(self.receiving_dir, filename), 'w')
+        fh.write(header)
+        fh.close()
+
+    def cycle(self, db):
+        feeder = FakeFeeder(self.receiving_dir, self.archive_dir, db,
+                            self.status, self.outbox)
+        idle = self.execute._cycle(db, feeder, self.status, self.tmpdir,
+                                   self.outbox)
+        return idle, feeder
+
+    def test_sending_facility(self):
+        self.write('plain', 'HOSP^1234^NPI')
+        self.write('archived', 'CLINIC', archived=True)
+        with open(os.path.join(self.receiving_dir, 'bad'), 'w') as fh:
+            fh.write('garbage\n')
+        feeder = FakeFeeder(self.receiving_dir, self.archive_dir, None,
+                            None, None)
+        self.assertEquals(feeder.sending_facility(
+            feeder.locate('plain')), 'HOSP')
+        self.assertEquals(feeder.sending_facility(
+            feeder.locate('archived', '2009-01-03T16:20:19')), 'CLINIC')
+        self.assertEquals(feeder.sending_facility(
+            feeder.locate('bad')), None)
+        self.assertEquals(feeder.sending_facility(
+            os.path.join(self.receiving_dir, 'missing')), None)
+
+    def test_caught_up(self):
+        idle, feeder = self.cycle(FakeDB())
+        self.assertEquals(idle, 5 * 60)
+        self.assertEquals(self.status.unfed, 0)
+
+    def test_delivery(self):
+        self.write('f1', 'HOSP')
+        self.write('f2', 'CLINIC', archived=True)
+        db = FakeDB([('f1', '2013-01-01T00:00:00'),
+                     ('f2', '2009-01-03T16:20:19')])
+        idle, feeder = self.cycle(db)
+        self.assertEquals(idle, 0)
+        self.assertEquals(sorted(feeder.posted), ['f1', 'f2'])
+        self.assertEquals(sorted(db.fed), ['f1', 'f2'])
+        self.assertEquals(self.outbox.outstanding(), [])
+        idle, feeder = self.cycle(db)
+        self.assertEquals(idle, 5 * 60)
+
+    def test_failed_delivery(self):
+        self.write('f1', 'HOSP')
+        db = FakeDB([('f1', '2013-01-01T00:00:00')])
+        feeder = FakeFeeder(self.receiving_dir, self.archive_dir, db,
+                            self.status, self.outbox)
+
+        def reject(filepath, filename):
+            raise RuntimeError("Error 400, 'Bad Request'")
+        feeder._post = reject
+        idle = self.execute._cycle(db, feeder, self.status, self.tmpdir,
+                                   self.outbox)
+        self.assertEquals(idle, self.execute.min_wait)
+        self.assertEquals(self.outbox.attempts, {'f1': 1})
+
+    def test_header_partners(self):
+        self.write('f1', 'HOSP')
+        self.write('f2', 'CLINIC')
+        self.cycle(FakeDB([('f1', '2013-01-01T00:00:00'),
+                           ('f2', '2013-01-01T00:00:00')]))
+        with open(self.outbox.path) as fh:
+            journal = fh.read()
+        self.assertTrue('f1\t2013-01-01T00:00:00\tHOSP' in journal)
+        self.assertTrue('f2\t2013-01-01T00:00:00\tCLINIC' in journal)
+
+    def test_saturated_partners(self):
+        for filename in ('f1', 'f2', 'f3', 'f4'):
+            self.write(filename, 'ignored')
+        db = FakeDB([(filename, '2013-01-01T00:00:00') for filename in
+                     ('f1', 'f2', 'f3', 'f4')],
+                    {'f1': 'HOSP', 'f2': 'HOSP', 'f3': 'HOSP',
+                     'f4': 'CLINIC'})
+        self.execute.partner_column = 'fromPartyId'
+        self.execute.max_partner_outstanding = 2
+        self.execute.scheduler = PartnerScheduler({'HOSP': (1, 0)})
+
+        # HOSP's budget only covers the first of its files
+        idle, feeder = self.cycle(db)
+        self.assertEquals(idle, 0)
+        self.assertEquals(sorted(feeder.posted), ['f1', 'f4'])
+
+        # With files pending, waiting on the budget skips discovery
+        idle, feeder = self.cycle(db)
+        self.assertEquals(len(db.queries), 1)
+        self.assertEquals(feeder.posted, [])
+        self.assertTrue(idle >= self.execute.min_wait)
+
+        # HOSP has a full share of the outbox, so is left undiscovered,
+        # and its unseen backlog still counts; files without a partner
+        # are still discovered
+        self.write('f5', 'ignored')
+        db.files.append(('f5', '2013-01-01T00:00:00'))
+        self.status.unfed = 1000
+        self.execute._discovered_at = 0
+        idle, feeder = self.cycle(db)
+        self.assertEquals(db.queries[-1], ['HOSP'])
+        self.assertEquals(feeder.posted, ['f5'])
+        self.assertEquals(self.status.unfed, 999)
+
+    def test_unlocatable(self):
+        self.outbox.enqueue([('gone', '2013-01-01T00:00:00', None)])
+        idle, feeder = self.cycle(FakeDB())
+        self.assertEquals(feeder.posted, [])
+        self.assertFalse('gone' in self.outbox)
+        idle, feeder = self.cycle(FakeDB())
+        self.assertEquals(idle, 5 * 60)
+
+
 def test_archive_by_date():
     #[('1231028419873', '2009-01-03T16:20:19')]
     results = archive_by_date('/tmp', '2009-01-03T16:20:19')
     assert('/tmp/2009-01' == results)
 
 
+def test_partner_scheduler():
+    scheduler = Execute.partner_scheduler('fromPartyId', 'A:60, *::1')
+    assert(scheduler.limits == {'A': (60.0, 0)})
+    assert(scheduler.default == (None, 1))
+    # priorities alone don't need the partner_column
+    Execute.partner_scheduler(None, 'A::5')
+    try:
+        Execute.partner_scheduler(None, '*:60')
+    except ValueError:
+        pass
+    else:
+        assert False, "rate limit accepted without partner_column"
+
+
 if '__main__' == __name__:
     unittest.main()
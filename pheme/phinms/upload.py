@@ -12,18 +12,45 @@ If the files option (-f) is used, only the named files will be
 uploaded, and then the process will shut down.
 
 Otherwise, this acts as a long running process, occasionally polling
-the receivers, such as the `phinms_receiver` for new files.
+the receivers, such as the `phinms_receiver` for new files.  Files are
+journaled in a local outbox ([phinms] outbox_dir, defaulting to the
+[general] log_dir) between discovery and being marked fed, so a
+restart resumes where it left off and delivery continues through short
+database outages.
+
+The --profile option profiles the given number of upload cycles,
+writing a profile per cycle into the log_dir.  Send SIGUSR1 to a
+running daemon to toggle profiling.
+
+The --check-schema option runs EXPLAIN on the queries run against the
+PHINMS and feeder tables, reporting any missing indexes, and exits.
+The same check is logged at startup.
+
+The --compact-feeder option bounds the size of the feeder table,
+rolling the rows for files fed over the given number of days ago into
+compact ranges, and exits.
+
+The --status option reports the current backlog (unfed count, oldest
+unfed file, drain rate and estimated time to catch up) as last
+recorded by the running daemon, and exits.
 
 Try `%prog --help` for more information.
 """
-from datetime import datetime
+from datetime import datetime, timedelta
+import gzip
 import logging
 from optparse import OptionParser
 import os
-from time import sleep
-from urllib3 import HTTPConnectionPool
+from time import sleep, time
 
+from pheme.phinms.asynclog import AsyncLogging, file_log
+from pheme.phinms.outbox import Outbox, run_workers
 from pheme.phinms.phinms_receiver import PHINMS_DB
+from pheme.phinms.profiling import CycleProfiler, MODES as PROFILE_MODES
+from pheme.phinms.readahead import ReadAhead
+from pheme.phinms.receivers import ReceiverPool
+from pheme.phinms.schedule import PartnerScheduler
+from pheme.phinms.status import BacklogStatus
 from pheme.util.config import Config, configure_logging
 from pheme.util.compression import expand_file
 from pheme.util.util import systemUnderLoad
@@ -59,12 +86,29 @@ def archive_by_date(base_dir, the_date):
                                                the_date.month))
 
 
+def printer(message):
+    """Print the message, for reports written to the terminal"""
+    print message
+
+
+def config_default(section, option, default=None):
+    """Return the configured value, or default if it isn't set"""
+    try:
+        value = Config().get(section, option)
+    except Exception:
+        return default
+    return default if value is None else value
+
+
 class Batchfile_Feeder(object):
     """Uploads avaiable batch files to PHEME_http_receiver channel """
 
-    def __init__(self, verbosity=0, source_db=None):
+    def __init__(self, verbosity=0, source_db=None, status=None,
+                 outbox=None, workers=1):
         self.verbosity = verbosity
         self.source_db = source_db
+        self.status = status
+        self.outbox = outbox
         config = Config()
         self.phinms_receiving_dir = config.get('phinms', 'receiving_dir')
         self.phinms_archive_dir = config.get('phinms', 'archive_dir')
@@ -76,11 +120,17 @@ class Batchfile_Feeder(object):
             raise ValueError("Can't find required directory %s" %
                              self.phinms_receiving_dir)
 
-        UPLOAD_PORT = config.get('pheme_http_receiver', 'port')
-        UPLOAD_HOST = config.get('pheme_http_receiver', 'host')
-        self.http_pool = HTTPConnectionPool(host=UPLOAD_HOST,
-                                            port=UPLOAD_PORT,
-                                            timeout=20)
+        # Either a list of endpoints, or the single host and port
+        endpoints = config_default('pheme_http_receiver', 'endpoints')
+        UPLOAD_PORT = config_default('pheme_http_receiver', 'port')
+        if endpoints:
+            endpoints = ReceiverPool.parse_endpoints(endpoints,
+                                                     UPLOAD_PORT)
+        else:
+            UPLOAD_HOST = config.get('pheme_http_receiver', 'host')
+            endpoints = [(UPLOAD_HOST, UPLOAD_PORT)]
+        self.receivers = ReceiverPool(endpoints, timeout=20,
+                                      maxsize=workers)
         self._copy_tempdir = None
 
     @property
@@ -110,7 +160,7 @@ class Batchfile_Feeder(object):
         with the service expectations.  For initial implementation,
         this is in the PHEME_http_receiver channel running in Mirth as an HTTP
         listener on the other side of the stunnel at [pheme_http_receiver]
-        {host,port}.
+        {host,port} or endpoints.
 
         """
         d = {}
@@ -128,28 +178,35 @@ class Batchfile_Feeder(object):
         :param filename: original filename (i.e. not a temp or zip version)
           matching the localFileName value from the workerqueue
 
-        raises an exception unless a 200 is returned from the server.
+        Returns the url of the receiver accepting the file; raises an
+        exception unless a 200 is returned from one of the configured
+        receivers.
 
         """
-        url = "%(scheme)s://%(host)s:%(port)s/" %\
-            {'scheme': self.http_pool.scheme, 'host':
-             self.http_pool.host,  'port': self.http_pool.port}
-        response = self.http_pool.request('POST',
-                                          url,
-                                          self.mime_parts(filepath, filename),
-                                          retries=0)
-        args = {'status': response.status, 'reason':
-                response.reason, 'file': filename,
-                'url': url}
-        if response.status != 200:
-            logging.error("Failed POST of %(file)s to %(url)s, "
-                          "%(reason)s", args)
-            raise RuntimeError("Error %(status)d, '%(reason)s' in "
-                               "posting %(file)s to %(url)s" % args)
-        else:
-            logging.info("%(file)s posted to %(url)s", args)
+        url = self.receivers.post(self.mime_parts(filepath, filename),
+                                  filename)
+        logging.info("%s posted to %s", filename, url)
+        return url
+
+    def _markfed(self, filename, details=None):
+        """Record the file as fed, keeping the backlog status current
+
+        :param filename: the file fed
+        :param details: dictionary of delivery facts for the feeder
+          table, see `PHINMS_DB.markfed`
+
+        When delivering from an outbox, the file is only acknowledged
+        in the outbox journal, to be marked fed in the next batched
+        `Outbox.commit()`.
 
-    def _feed(self, filepath, filename):
+        """
+        if self.outbox is not None:
+            return self.outbox.ack(filename, details)
+        count = self.source_db.markfed([filename, ], {filename: details})
+        if self.status is not None:
+            self.status.fed(count)
+
+    def _feed(self, filepath, filename, first=None):
         """Feed the file to mirth, and handle bookkeeping
 
         Upload the given file to the PHEME_http_receiver channel for
@@ -159,31 +216,55 @@ class Batchfile_Feeder(object):
         :param filepath: full path to file containing data to upload
         :param filename: original filename (i.e. not a temp or zip version)
           matching the localFileName value from the workerqueue
+        :param first: the first line of the file, if already read
 
         """
         # Annually, when one of the upstream certificates expire,
         # PHINMS can't decrypt the files.  If the file looks illformed,
         # alert via logging, and move on.
-        with open(filepath, 'r') as fh:
-            first = fh.readline()
+        if first is None:
+            with open(filepath, 'r') as fh:
+                first = fh.readline()
 
+        fields = {'file': filename}
         if first and first.startswith('FHS|'):
+            # Attempts are counted in the outbox, surviving restarts;
+            # without one, each file is only tried the once
+            attempts = 1
+            if self.outbox is not None:
+                attempts = self.outbox.attempt(filename)
+            fields['attempts'] = attempts
+            start = time()
             try:
-                self._post(filepath, filename)
-                self.source_db.markfed([filename, ])
+                fields['url'] = self._post(filepath, filename)
+                fields['bytes'] = os.path.getsize(filepath)
+                fields['duration'] = round(time() - start, 3)
+                self._markfed(filename, {
+                    'status': 'fed', 'attempts': attempts,
+                    'uploaded_at': datetime.now().strftime(
+                        "%Y-%m-%d %H:%M:%S"),
+                    'duration': fields['duration'],
+                    'bytes': fields['bytes']})
             except Exception, e:
                 # NB we do NOT markfed in this case - server may be
                 # unreachable or some other situation - continue trying
                 logging.error("Error: failed to upload %s", filename)
                 logging.exception(e)
+                fields['duration'] = round(time() - start, 3)
+                fields['error'] = str(e)
+                event = 'failed'
+            else:
+                event = 'posted'
         else:
             logging.error("Error: batchfile '%s' doesn't begin with"
                           " expected FHS, but rather: '%s'", filename,
                           first[:25])
             # Mark fed, or we'll cycle on these types of files.
-            self.source_db.markfed([filename, ])
+            self._markfed(filename, {'status': 'rejected', 'attempts': 0})
+            event = 'rejected'
+        file_log.info(event, extra={'fields': fields})
 
-    def _copy(self, filepath, filename):
+    def _copy(self, filepath, filename, first=None):
         """Simply copy the file to a filesystem dir
 
         For debugging and reporting needs, just copy the file rather
@@ -193,6 +274,7 @@ class Batchfile_Feeder(object):
         :param filepath: full path to file containing data to upload
         :param filename: original filename (i.e. not a temp or zip version)
           matching the localFileName value from the workerqueue
+        :param first: unused, for compatibility with `_feed()`
 
         """
         with open(filepath, 'r') as fh:
@@ -204,47 +286,115 @@ class Batchfile_Feeder(object):
                 logging.error("Error: failed to copy %s", filename)
                 logging.exception(e)
 
-    def upload(self, filename, filedate=None):
-        """Upload the file to the PHEME_http_receiver channel
+    def sending_facility(self, src):
+        """Return the sending facility from the file's FHS header
 
-        :param filename: batch filename to upload
+        :param src: path to the batch file, or its archived version
+
+        Returns the first component of FHS-4, or None if the header
+        can't be read.
+
+        """
+        try:
+            if self.is_archived(src):
+                fh = gzip.open(src, 'rb')
+            else:
+                fh = open(src, 'r')
+            try:
+                first = fh.readline()
+            finally:
+                fh.close()
+        except IOError, e:
+            logging.error("Error: can't read header of '%s': %s", src, e)
+            return None
+        fields = first.split('|')
+        if fields[0] != 'FHS' or len(fields) < 4:
+            return None
+        return fields[3].split('^')[0] or fields[3] or None
+
+    def locate(self, filename, filedate=None):
+        """Resolve the path to the batch file
+
+        :param filename: batch filename to locate
         :param filedate: needs to be defined for files that have been
             archived, as the date is necessary to locate the archived
             file.
 
+        Returns the path to the file in the receiving_dir, or failing
+        that the path to the gzipped version in the archive_dir.
+        Returns None if neither can be found.
+
         """
         src = os.path.join(self.phinms_receiving_dir, filename)
         if os.path.exists(src):
             # Common case, the file is available in the receiving_dir
             # as it hasn't yet been archived
-            self._feed(src, filename)
-        else:
-            # See if we can find the archived version.  If so, it
-            # needs to be expanded before adding to the
-            # channelPath
-            try:
-                archive_dir = archive_by_date(self.phinms_archive_dir,
-                                              filedate)
-                src = os.path.join(archive_dir, filename + '.gz')
-                if os.path.exists(src):
-                    expanded_file = expand_file(filename=src,
-                                                zip_protocol='gzip',
-                                                output='file')
-                    self._feed(expanded_file, filename)
-                    # remove the expanded_file, providing the source
-                    # is still intact
-                    if os.path.exists(src):
-                        os.remove(expanded_file)
-                    else:
-                        raise RuntimeError("Archived batch file gone "
-                                           "after expansion")
-                else:
-                    logging.error("Couldn't locate hl7 batch file "
-                                  "'%s' using date %s", filename,
-                                  str(filedate))
-            except:
-                logging.error("failed to locate hl7 batch file "
-                              "'%s'", filename)
+            return src
+
+        # See if we can find the archived version.
+        try:
+            archive_dir = archive_by_date(self.phinms_archive_dir,
+                                          filedate)
+        except ValueError:
+            logging.error("failed to locate hl7 batch file "
+                          "'%s'", filename)
+            return None
+        src = os.path.join(archive_dir, filename + '.gz')
+        if os.path.exists(src):
+            return src
+        logging.error("Couldn't locate hl7 batch file "
+                      "'%s' using date %s", filename, str(filedate))
+        return None
+
+    def is_archived(self, src):
+        """True if src, as returned by `locate()`, is an archived file"""
+        return os.path.dirname(src) != os.path.normpath(
+            self.phinms_receiving_dir)
+
+    def deliver(self, src, filename, expanded_file=None, first=None):
+        """Feed the file found at src by `locate()`
+
+        :param src: path to the batch file, or its archived version
+        :param filename: original filename (i.e. not a temp or zip version)
+          matching the localFileName value from the workerqueue
+        :param expanded_file: path to the archived src already expanded,
+          see `ReadAhead`
+        :param first: first line of the expanded_file, if already read
+
+        """
+        if not self.is_archived(src):
+            return self._feed(src, filename)
+
+        # The archived version needs to be expanded before feeding
+        try:
+            if expanded_file is None:
+                expanded_file = expand_file(filename=src,
+                                            zip_protocol='gzip',
+                                            output='file')
+            self._feed(expanded_file, filename, first)
+            # remove the expanded_file, providing the source
+            # is still intact
+            if os.path.exists(src):
+                os.remove(expanded_file)
+            else:
+                raise RuntimeError("Archived batch file gone "
+                                   "after expansion")
+        except:
+            logging.error("failed to expand hl7 batch file "
+                          "'%s'", filename)
+
+    def upload(self, filename, filedate=None):
+        """Upload the file to the PHEME_http_receiver channel
+
+        :param filename: batch filename to upload
+        :param filedate: needs to be defined for files that have been
+            archived, as the date is necessary to locate the archived
+            file.
+
+        """
+        src = self.locate(filename, filedate)
+        if src:
+            self.deliver(src, filename)
 
 
 class Execute(object):
@@ -257,6 +407,24 @@ class Execute(object):
         self.files = None
         self.daemon_mode = True
         self.copy_tempdir = None
+        self.show_status = False
+        self.profile_cycles = 0
+        self.profile_mode = 'cprofile'
+        self.workers = 1
+        self.json_log = False
+        self.async_log = None
+        self.expand_processes = 0
+        self.read_ahead = None
+        self.schema_check = False
+        self.create_indexes = False
+        self.compact_days = None
+        self.partner_column = None
+        self.scheduler = None
+        self.max_outstanding = 20 * PHINMS_DB.LIMIT
+        self.max_partner_outstanding = 2 * PHINMS_DB.LIMIT
+        self.discovery_interval = 30
+        self.min_wait = 5
+        self._discovered_at = 0
 
     def _get_progression(self):
         return self.__progression
@@ -272,38 +440,286 @@ class Execute(object):
 
     progression = property(_get_progression, _set_progression)
 
+    def check_schema(self, source_db, report=logging.warn):
+        """Check the PHINMS and feeder tables support our queries
+
+        Reports any problems found via report, applying fixes to the
+        tables we own if self.create_indexes is set, and suggesting
+        fixes to those we don't.  Returns the list of problems.
+
+        """
+        source_db._create_feeder_table()
+        problems, fixes = source_db.check_schema()
+        for problem in problems:
+            report("schema check: %s" % problem)
+        owned = [fix for fix in fixes if fix[0]]
+        if owned and self.create_indexes:
+            source_db.apply_fixes(owned)
+        else:
+            for _, sql in owned:
+                report("schema check: suggested fix (apply with "
+                       "--create-indexes): %s" % sql)
+        for _, sql in [fix for fix in fixes if not fix[0]]:
+            report("schema check: suggested fix, for the DBA as the "
+                   "PHINMS tables aren't ours: %s" % sql)
+        return problems
+
+    def report_status(self):
+        """Print the backlog status last recorded by the daemon
+
+        Falls back to a single full count against the PHINMS database
+        if the daemon hasn't yet recorded a snapshot.
+
+        """
+        log_dir = Config().get('general', 'log_dir')
+        snapshot = BacklogStatus.load(log_dir)
+        status = BacklogStatus()
+        if snapshot is None:
+            logging.warn("no status snapshot in %s, counting backlog",
+                         log_dir)
+            source_db = PHINMS_DB()
+            try:
+                status.seed(source_db)
+            finally:
+                source_db.close()
+        print status.report(snapshot)
+
+    def _commit(self, outbox, source_db, status):
+        """Mark the outbox acknowledgements fed, tolerating DB outages"""
+        try:
+            status.fed(outbox.commit(source_db))
+        except Exception, e:
+            logging.error("Error: markfed failed, %d acknowledgement(s) "
+                          "retained in outbox: %s", len(outbox.acked), e)
+
+    def _cycle(self, source_db, feeder, status, log_dir, outbox=None):
+        """Discover and upload a single batch of files
+
+        Returns the seconds to idle before the next cycle; 0 unless
+        there was nothing to do, i.e. a daemon that has caught up, one
+        waiting on the partners' upload budgets, or one whose every
+        delivery failed, in the latter cases at least `self.min_wait`.
+
+        With an outbox, files are journaled on discovery and delivered
+        from the outbox by `self.workers` threads, and the database is
+        only touched for discovery and the batched `markfed`, either of
+        which may fail without interrupting delivery.  Discovery skips
+        the files already in the outbox, and each cycle's uploads are
+        ordered and rate limited per sending partner by
+        `self.scheduler`.  With a [phinms] partner_column configured,
+        discovery also skips the partners with a full share of the
+        outbox, which rate limits require, see `partner_scheduler()`.
+        While files remain pending, discovery runs at most every
+        `self.discovery_interval` seconds, so waiting on the budgets
+        doesn't hit the database every cycle.
+
+        """
+        if systemUnderLoad():
+            logging.info("system under load - continue anyhow")
+
+        if self.files:
+            # Look up the given files for their filedates
+            self.files = source_db.name_dates(self.files)
+            for batch_file, filedate in self.files:
+                feeder.upload(batch_file, filedate)
+            self.files = None  # done with that batch
+            return 0
+
+        outstanding, saturated, pending = [], [], []
+        if outbox is not None:
+            # Acknowledgements left from the last cycle or a restart
+            self._commit(outbox, source_db, status)
+            outstanding = outbox.outstanding()
+            pending = [entry[1] for entry in outbox.pending_items()]
+            if self.partner_column:
+                saturated = self._saturated(outbox)
+
+        files = []
+        if len(outstanding) >= self.max_outstanding:
+            logging.info("%d files in outbox, skipping discovery",
+                         len(outstanding))
+        elif outbox is not None and len(outbox) and \
+                time() - self._discovered_at < self.discovery_interval:
+            logging.debug("%d files pending in outbox, deferring "
+                          "discovery", len(outbox))
+        else:
+            self._discovered_at = time()
+            try:
+                status.refresh(source_db)
+                files = source_db.filelist(
+                    self.progression, exclude=outstanding,
+                    partner_column=self.partner_column,
+                    exclude_partners=saturated)
+                status.discovered(files, self.progression,
+                                  len(outstanding), saturated, pending)
+            except Exception, e:
+                if outbox is None:
+                    raise
+                logging.error("Error: discovery failed, continuing with "
+                              "%d file(s) in outbox: %s", len(outbox), e)
+        logging.info(status.report())
+        status.save(log_dir)
+
+        if outbox is None:
+            for batch_file, filedate in files:
+                feeder.upload(batch_file, filedate)
+            return 0 if files else 5 * 60
+
+        located = [(filename, filedate, feeder.locate(filename, filedate))
+                   for filename, filedate in files]
+        located = [entry for entry in located if entry[2]]
+        outbox.enqueue([(filename, filedate, partner) for
+                        (filename, filedate, _), partner in
+                        zip(located, self._partners(source_db, feeder,
+                                                    located))])
+
+        entries = [(partner, (filename, filedate)) for filename, filedate,
+                   partner in outbox.pending_items()]
+        items, wait = self.scheduler.schedule(entries)
+        if items:
+            items = self._locate_pending(feeder, outbox, items)
+            if self.read_ahead is not None:
+                items = self.read_ahead.imap(items, feeder.is_archived)
+            pending = len(outbox)
+            run_workers(items, feeder.deliver, self.workers)
+            self._commit(outbox, source_db, status)
+            if len(outbox) < pending:
+                return 0
+            # Every delivery failed; back off rather than spin
+            logging.debug("no files delivered, backing off")
+            return self.min_wait
+        if wait:
+            logging.debug("partner budgets exhausted")
+            return max(wait, self.min_wait)
+        return 5 * 60
+
+    def _locate_pending(self, feeder, outbox, items):
+        """Generate (path, filename) for each (filename, filedate) item
+
+        The files are located afresh, as they may have been archived
+        since discovery.  Those no longer found are dropped from the
+        outbox, rather than failing delivery every cycle.
+
+        """
+        for filename, filedate in items:
+            src = feeder.locate(filename, filedate)
+            if src:
+                yield src, filename
+            else:
+                outbox.drop(filename)
+
+    @staticmethod
+    def partner_scheduler(partner_column, partner_limits):
+        """Build the `PartnerScheduler` for the configured limits
+
+        :param partner_column: the [phinms] partner_column, if any
+        :param partner_limits: the [phinms] partner_limits
+
+        Rate limits require the partner_column.  Partners taken from
+        the file headers are only known once discovered, so a rate
+        limited partner's backlog would fill the outbox and stall
+        discovery of every other partner's files.  Raises ValueError
+        if rate limits are configured without it.
+
+        """
+        limits = PartnerScheduler.parse_limits(partner_limits)
+        default = limits.pop('*', (None, 0))
+        if not partner_column and any(
+                rate is not None for rate, _ in limits.values() +
+                [default]):
+            raise ValueError("[phinms] partner_limits sets rate limits, "
+                             "which require [phinms] partner_column")
+        return PartnerScheduler(limits, default)
+
+    def _saturated(self, outbox):
+        """Return the partners with a full share of the outbox
+
+        Discovery skips their files until some are delivered, so a
+        partner with a large backlog can't crowd the others' files out
+        of the outbox.
+
+        """
+        counts = {}
+        for entry in outbox.pending_items():
+            counts[entry[2]] = counts.get(entry[2], 0) + 1
+        return [partner for partner, count in counts.items()
+                if partner is not None and
+                count >= self.max_partner_outstanding]
+
+    def _partners(self, source_db, feeder, located):
+        """Return the sending partner of each located file
+
+        :param located: list of (filename, filedate, path) touples
+
+        Taken from the [phinms] partner_column of the workerqueue if
+        configured, otherwise the sending facility in the file header.
+
+        """
+        if not self.partner_column:
+            return [feeder.sending_facility(path) for _, _, path in
+                    located]
+        try:
+            partners = source_db.partners([entry[0] for entry in located],
+                                          self.partner_column)
+        except Exception, e:
+            logging.error("Error: partner lookup failed: %s", e)
+            partners = {}
+        return [str(partners[filename]) if partners.get(filename)
+                is not None else None for filename, _, _ in located]
+
     def execute(self):
+        self.partner_column = config_default('phinms', 'partner_column')
+        self.scheduler = self.partner_scheduler(
+            self.partner_column,
+            config_default('phinms', 'partner_limits', ''))
         source_db = PHINMS_DB()
+        status = BacklogStatus()
+        log_dir = Config().get('general', 'log_dir')
+        status.restore(log_dir)
+        outbox = None
+        if self.daemon_mode and not self.copy_tempdir:
+            outbox = Outbox(config_default('phinms', 'outbox_dir',
+                                           log_dir))
         feeder = Batchfile_Feeder(verbosity=self.verbosity,
-                                  source_db=source_db)
+                                  source_db=source_db, status=status,
+                                  outbox=outbox, workers=self.workers)
         feeder.copy_tempdir = self.copy_tempdir
+        profiler = CycleProfiler(log_dir, mode=self.profile_mode,
+                                 cycles=self.profile_cycles or 1)
+        if self.profile_cycles:
+            profiler.arm()
+        if self.daemon_mode:
+            profiler.install_signal_handler()
+        if not self.copy_tempdir:
+            # Copying doesn't track anything, so leaves the tables be
+            source_db._create_feeder_table()
+            try:
+                self.check_schema(source_db)
+            except Exception, e:
+                logging.error("schema check failed: %s", e)
 
         while True:
             try:  # long running process, capture interrupt
-                if systemUnderLoad():
-                    logging.info("system under load - continue anyhow")
+                with profiler.cycle():
+                    idle = self._cycle(source_db, feeder, status,
+                                       log_dir, outbox)
+                if self.async_log is not None:
+                    self.async_log.summarise()
+
+                # If we didn't get any back, we've caught up (or are
+                # waiting on the partner budgets), take this
+                # opportunity to sleep for a while
+                if idle:
+                    logging.debug("nothing to do, sleeping %ds", idle)
+                    sleep(idle)
 
-                if self.files:
-                    # Look up the given files for their filedates
-                    self.files = source_db.name_dates(self.files)
-                else:
-                    self.files = source_db.filelist(self.progression)
-
-                    # If we didn't get any back, we've caught up, take
-                    # this opportunity to sleep for a while
-                    if self.daemon_mode and not self.files:
-                        logging.debug("no files found, sleeping")
-                        sleep(5 * 60)
-
-                for batch_file, filedate in self.files:
-                    feeder.upload(batch_file, filedate)
-
-                self.files = None  # done with that batch
                 if not self.daemon_mode:
                     raise(SystemExit('non daemon-mode exit'))
 
             except:
                 logging.info("Shutting down")
+                if self.read_ahead is not None:
+                    self.read_ahead.close()
                 raise  # now exit
             finally:
                 source_db.close()
@@ -326,6 +742,48 @@ class Execute(object):
                           default=None, action='store',
                           help="Don't upload or track, just copy files "
                           "to named directory")
+        parser.add_option("-w", "--workers", dest="workers",
+                          default=self.workers, type='int',
+                          help="number of concurrent delivery workers "
+                          "(default %default)")
+        parser.add_option("--expand-processes", dest="expand_processes",
+                          default=self.expand_processes, type='int',
+                          metavar='N',
+                          help="expand archived files in a pool of N "
+                          "processes, ahead of the delivery workers")
+        parser.add_option("--json-log", dest="json_log",
+                          default=self.json_log, action='store_true',
+                          help="write a structured (JSON) record per "
+                          "file to the log_dir")
+        parser.add_option("--check-schema", dest="schema_check",
+                          default=self.schema_check, action='store_true',
+                          help="check the PHINMS and feeder tables have "
+                          "the indexes the queries need, then exit")
+        parser.add_option("--create-indexes", dest="create_indexes",
+                          default=self.create_indexes,
+                          action='store_true',
+                          help="create any indexes missing from the "
+                          "tables we own, found by the schema check")
+        parser.add_option("--compact-feeder", dest="compact_days",
+                          default=self.compact_days, type='int',
+                          metavar='DAYS',
+                          help="roll feeder table rows for files fed "
+                          "over DAYS ago into compact ranges, then exit")
+        parser.add_option("--status", dest="status",
+                          default=self.show_status, action='store_true',
+                          help="report the current backlog and lag, "
+                          "then exit")
+        parser.add_option("--profile", dest="profile_cycles",
+                          default=self.profile_cycles, type='int',
+                          metavar='N',
+                          help="profile the first N cycles, writing a "
+                          "profile per cycle to the log_dir.  SIGUSR1 "
+                          "toggles profiling of a running daemon")
+        parser.add_option("--profile-mode", dest="profile_mode",
+                          default=self.profile_mode,
+                          choices=PROFILE_MODES,
+                          help="'cprofile' (pstats output) or 'sample' "
+                          "(wall-clock sampling, collapsed stack output)")
 
         (options, args) = parser.parse_args()
         if not parser.values.namedfiles:
@@ -342,8 +800,51 @@ class Execute(object):
                 self.files.append(filename)
 
         self.copy_tempdir = parser.values.tempdir
+        if parser.values.expand_processes and (not self.daemon_mode or
+                                               self.copy_tempdir):
+            parser.error("--expand-processes only applies to uploads in "
+                         "daemon mode, not with -f or --copy-to-tempdir")
+        self.show_status = parser.values.status
+        self.profile_cycles = parser.values.profile_cycles
+        self.workers = parser.values.workers
+        self.json_log = parser.values.json_log
+        self.expand_processes = parser.values.expand_processes
+        self.schema_check = parser.values.schema_check
+        self.create_indexes = parser.values.create_indexes
+        self.compact_days = parser.values.compact_days
+        self.profile_mode = parser.values.profile_mode
         self.verbosity = parser.values.verbosity
         configure_logging(verbosity=self.verbosity, logfile='stderr')
+        if self.show_status:
+            self.report_status()
+            return
+        if self.compact_days is not None:
+            source_db = PHINMS_DB()
+            try:
+                source_db._create_feeder_table()
+                source_db.compact_feeder(datetime.now() -
+                                         timedelta(days=self.compact_days))
+            finally:
+                source_db.close()
+            return
+        if self.schema_check:
+            source_db = PHINMS_DB()
+            try:
+                if not self.check_schema(source_db, report=printer):
+                    print "schema check: OK"
+            finally:
+                source_db.close()
+            return
+        if self.expand_processes:
+            # Fork the pool before starting the logging thread or
+            # connecting to the database, neither of which the forked
+            # processes should inherit
+            self.read_ahead = ReadAhead(self.expand_processes)
+        json_path = None
+        if self.json_log:
+            json_path = os.path.join(Config().get('general', 'log_dir'),
+                                     'phinms_upload_files.json')
+        self.async_log = AsyncLogging(json_path=json_path)
         self.execute()
 
 